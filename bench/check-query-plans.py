@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Run EXPLAIN QUERY PLAN against our hot queries and fail if any
+# of them fall back to scanning the tweets or rollups table.
+#
+
+import argparse
+import logging as logger
+import logging.config
+import sys
+
+sys.path.append("lib")
+from queries import check_query_plans
+from tables import get_database_url, get_session
+
+parser = argparse.ArgumentParser(description = "Check that our hot queries don't scan the tweets or rollups table.")
+parser.add_argument("--db-url", type = str, help = "Database to check (Default: TWEETS_DATABASE_URL, or tweets.db)")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+session = get_session(url = args.db_url or get_database_url())
+
+failures = check_query_plans(session)
+
+for name, plan in failures.items():
+	logger.error("Query '{}' scans the tweets or rollups table: {}".format(name, plan))
+
+if failures:
+	sys.exit(1)
+
+logger.info("All query plans use an index. ok=1")
+
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Benchmark fetching, reporting and backing up the same database at the same time,
+# from separate processes, the way our Docker containers do.
+#
+# For a few seconds each, we run:
+#
+# - writers: Write pages of new tweets and their rollups, like 1-fetch-tweets.py
+# - readers: Build reports from the rollups, like 2-telegram-bot.py --no-memory-cache
+# - a backup: Copy the database with SQLite's backup API, like 2-backup-tweets.sh
+#
+# This is done once with SQLite's defaults (a rollback journal, and a new connection
+# for every session), and once with our storage profile from tables.get_engine().
+# For each we report throughput, latencies, and how many "database is locked" errors we got.
+#
+# With --db-url, another database such as Postgres is benchmarked instead, with the
+# engine from tables.get_engine(). That database is used as is, so it should be a
+# scratch one. Backups of those are up to the database, so there's no backup process.
+#
+
+import argparse
+import datetime
+import logging as logger
+import logging.config
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+sys.path.append("lib")
+from queries import get_last_tweet
+from rollups import get_rollup_stats_windows, rebuild_rollups, update_rollups
+from tables import create_all, get_engine, insert_ignore, Rollups, Tweets
+
+
+parser = argparse.ArgumentParser(description = "Benchmark concurrent fetching, reporting and backups against one database.")
+parser.add_argument("--db", type = str, help = "Database to benchmark against, created if it doesn't exist (Default: /tmp/contention.db)", default = "/tmp/contention.db")
+parser.add_argument("--db-url", type = str, help = "Benchmark this database instead of a SQLite file, such as postgresql://localhost/contention")
+parser.add_argument("--rows", type = int, help = "How many tweets to start with (Default: 500000)", default = 500000)
+parser.add_argument("--users", type = int, help = "How many users to spread the tweets across (Default: 4)", default = 4)
+parser.add_argument("--writers", type = int, help = "How many writing processes to run (Default: 2)", default = 2)
+parser.add_argument("--readers", type = int, help = "How many reporting processes to run (Default: 2)", default = 2)
+parser.add_argument("--page", type = int, help = "How many tweets each write has in it (Default: 200)", default = 200)
+parser.add_argument("--seconds", type = float, help = "How long to run each profile for (Default: 15)", default = 15)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+#
+# When the newest tweet we start with was created. New tweets come after this.
+#
+end_time_t = 1546300800
+
+
+#
+# Create our database and fill it with tweets and their rollups.
+#
+def generate(url):
+
+	logger.info("Generating {} rows in {}...".format(args.rows, repr(make_url(url))))
+
+	db = get_engine(url, profile = [])
+	create_all(db)
+
+	random.seed(1)
+
+	def get_rows():
+		for i in range(args.rows):
+			time_t = end_time_t - (args.rows - i) * 180 // args.users
+			reply_tweet_id = None
+			reply_age = 0
+			if i % 3 == 0:
+				reply_tweet_id = 10 ** 15 + i
+				reply_age = random.randint(30, 86400)
+			yield({"tweet_id": 10 ** 12 + i, "username": "user{}".format(i % args.users),
+				"time_t": time_t, "date": datetime.datetime.utcfromtimestamp(time_t),
+				"text": "Tweet {}".format(i), "reply_tweet_id": reply_tweet_id, "reply_age": reply_age})
+
+	#
+	# SQLite is much quicker to fill without SQLAlchemy in the way.
+	#
+	if db.dialect.name == "sqlite":
+		conn = sqlite3.connect(db.url.database)
+		conn.executemany("INSERT INTO tweets (tweet_id, username, time_t, date, text, "
+			+ "reply_tweet_id, reply_age) VALUES (:tweet_id, :username, :time_t, :date, "
+			+ ":text, :reply_tweet_id, :reply_age)", ( dict(row, date = str(row["date"]) + ".000000")
+			for row in get_rows() ))
+		conn.commit()
+		conn.close()
+
+	else:
+		rows = []
+		for row in get_rows():
+			rows.append(row)
+			if len(rows) == 10000:
+				db.execute(Tweets.__table__.insert(), rows)
+				rows = []
+		if rows:
+			db.execute(Tweets.__table__.insert(), rows)
+
+	rebuild_rollups(sessionmaker(bind = db)())
+	db.dispose()
+
+
+#
+# Return an engine for one of our profiles.
+#
+def get_profile_engine(profile, url):
+
+	if profile == "default":
+		return(create_engine(url))
+
+	return(get_engine(url))
+
+
+#
+# Return the value at a percentile of a list, in milliseconds.
+#
+def get_ms(values, percentile):
+
+	if not values:
+		return(0)
+
+	values = sorted(values)
+	return(values[min(int(len(values) * percentile / 100), len(values) - 1)] * 1000)
+
+
+#
+# Write pages of new tweets, each in its own transaction, until we're out of time.
+#
+def writer(profile, url, index, results):
+
+	session = sessionmaker(bind = get_profile_engine(profile, url))()
+	username = "user{}".format(index % args.users)
+	retval = {"kind": "writer", "count": 0, "errors": 0, "latencies": []}
+
+	deadline = time.time() + args.seconds
+	num = 0
+
+	while time.time() < deadline:
+
+		rows = []
+		for i in range(args.page):
+			num += 1
+			time_t = end_time_t + num * 60
+			rows.append({"username": username, "date": datetime.datetime.utcfromtimestamp(time_t),
+				"time_t": time_t, "tweet_id": 10 ** 13 + index * 10 ** 9 + num,
+				"text": "New tweet {}".format(num), "url": "", "reply_age": 0,
+				"reply_tweet_id": None, "reply_username": None})
+
+		start = time.time()
+		try:
+			session.execute(insert_ignore(session, Tweets.__table__), rows)
+			update_rollups(session, [ (username, row["time_t"]) for row in rows ])
+			session.commit()
+			retval["count"] += len(rows)
+			retval["latencies"].append(time.time() - start)
+
+		except OperationalError as e:
+			session.rollback()
+			retval["errors"] += 1
+
+	results.put(retval)
+
+
+#
+# Build reports for a 1 day and a 7 day window until we're out of time.
+#
+def reader(profile, url, index, results):
+
+	session = sessionmaker(bind = get_profile_engine(profile, url))()
+	retval = {"kind": "reader", "count": 0, "errors": 0, "latencies": []}
+
+	deadline = time.time() + args.seconds
+	num = 0
+
+	while time.time() < deadline:
+
+		username = "user{}".format((index + num) % args.users)
+		num += 1
+
+		start = time.time()
+		try:
+			get_rollup_stats_windows(session, username, [ end_time_t - 86400, end_time_t - 7 * 86400 ])
+			get_last_tweet(session, username)
+			session.commit()
+			retval["count"] += 1
+			retval["latencies"].append(time.time() - start)
+
+		except OperationalError as e:
+			session.rollback()
+			retval["errors"] += 1
+
+	results.put(retval)
+
+
+#
+# Back up the database once a second until we're out of time.
+#
+def backup(profile, url, index, results):
+
+	retval = {"kind": "backup", "count": 0, "errors": 0, "latencies": []}
+	filename = make_url(url).database
+	target_filename = "{}.backup".format(filename)
+
+	deadline = time.time() + args.seconds
+
+	while time.time() < deadline:
+
+		start = time.time()
+		try:
+			source = sqlite3.connect(filename, timeout = 5)
+			target = sqlite3.connect(target_filename)
+			source.backup(target)
+			target.close()
+			source.close()
+			retval["count"] += 1
+			retval["latencies"].append(time.time() - start)
+
+		except sqlite3.OperationalError as e:
+			retval["errors"] += 1
+
+		time.sleep(max(start + 1 - time.time(), 0))
+
+	if os.path.exists(target_filename):
+		os.unlink(target_filename)
+	results.put(retval)
+
+
+#
+# Make a fresh copy of our SQLite database for a profile, and return its URL.
+#
+def copy_sqlite(profile):
+
+	filename = "{}.{}".format(args.db, profile)
+	shutil.copy(args.db, filename)
+
+	conn = sqlite3.connect(filename)
+	if profile == "default":
+		conn.execute("PRAGMA journal_mode = DELETE")
+	else:
+		conn.execute("PRAGMA journal_mode = WAL")
+	conn.close()
+
+	return("sqlite:///" + filename)
+
+
+#
+# Remove the tweets and rollups that our last run wrote to a database we didn't copy.
+#
+def reset(url):
+
+	db = get_engine(url)
+	with db.begin() as conn:
+		conn.execute(Tweets.__table__.delete().where(Tweets.time_t > end_time_t))
+		conn.execute(Rollups.__table__.delete().where(Rollups.bucket_time_t >= end_time_t))
+	db.dispose()
+
+
+#
+# Run all of our processes against our database, and log how they did.
+#
+# url - The database to use. Unless it's from --db-url, it's copied first,
+#	so each profile starts from the same place.
+#
+def run(profile, url):
+
+	if not args.db_url:
+		url = copy_sqlite(profile)
+		backups = 1
+	else:
+		reset(url)
+		backups = 0
+
+	results = multiprocessing.Queue()
+	processes = []
+	for (func, num) in [ (writer, args.writers), (reader, args.readers), (backup, backups) ]:
+		for index in range(num):
+			processes.append(multiprocessing.Process(target = func, args = (profile, url, index, results)))
+
+	for process in processes:
+		process.start()
+
+	totals = { kind: {"count": 0, "errors": 0, "latencies": []} for kind in [ "writer", "reader", "backup" ] }
+	for process in processes:
+		result = results.get(timeout = args.seconds + 60)
+		total = totals[result["kind"]]
+		total["count"] += result["count"]
+		total["errors"] += result["errors"]
+		total["latencies"] += result["latencies"]
+
+	for process in processes:
+		process.join()
+
+	if not args.db_url:
+		filename = make_url(url).database
+		for suffix in [ "", "-wal", "-shm" ]:
+			if os.path.exists(filename + suffix):
+				os.unlink(filename + suffix)
+
+	logger.info("profile={} tweets_per_sec={:.0f} write_p50_ms={:.1f} write_p99_ms={:.1f} write_errors={}".format(
+		profile, totals["writer"]["count"] / args.seconds, get_ms(totals["writer"]["latencies"], 50),
+		get_ms(totals["writer"]["latencies"], 99), totals["writer"]["errors"]))
+	logger.info("profile={} reports_per_sec={:.1f} report_p50_ms={:.1f} report_p99_ms={:.1f} report_errors={}".format(
+		profile, totals["reader"]["count"] / args.seconds, get_ms(totals["reader"]["latencies"], 50),
+		get_ms(totals["reader"]["latencies"], 99), totals["reader"]["errors"]))
+	if backups:
+		logger.info("profile={} backups={} backup_p50_ms={:.1f} backup_errors={}".format(
+			profile, totals["backup"]["count"], get_ms(totals["backup"]["latencies"], 50),
+			totals["backup"]["errors"]))
+
+
+if args.db_url:
+
+	db = get_engine(args.db_url)
+	create_all(db)
+	num_rows = db.execute(Tweets.__table__.count()).scalar()
+	db.dispose()
+
+	if not num_rows:
+		generate(args.db_url)
+
+	profiles = [ ("pooled", args.db_url) ]
+
+else:
+
+	if not os.path.exists(args.db):
+		generate("sqlite:///" + args.db)
+
+	profiles = [ ("default", "sqlite:///" + args.db), ("wal", "sqlite:///" + args.db) ]
+
+logger.info("Running {} writers, {} readers and {} for {} seconds per profile...".format(
+	args.writers, args.readers, "no backups" if args.db_url else "a backup", args.seconds))
+
+for (profile, url) in profiles:
+	run(profile, url)
+
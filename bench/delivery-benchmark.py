@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Benchmark and check our Telegram delivery queue against our fake Bot API.
+#
+# A round of reports is fanned out to a number of chats, each report is queued twice
+# to make sure duplicates are dropped, and the fake API fails some messages at random
+# so that retries get exercised. One chat doesn't exist, so its messages are given up on.
+#
+# We compare how long the report loop is held up against sending each message
+# ourselves, and then check that:
+#
+# - Every message to every real chat was delivered exactly once
+# - No chat got more than one message a second, and we never sent more than 30 a second
+#
+
+import argparse
+import logging as logger
+import logging.config
+import os
+import sys
+import time
+
+import requests
+
+import fake_telegram
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/lib")
+from delivery import Delivery
+
+
+parser = argparse.ArgumentParser(description = "Benchmark our Telegram delivery queue against a fake Bot API.")
+parser.add_argument("--chats", type = int, help = "How many chats to send to (Default: 50)", default = 50)
+parser.add_argument("--reports", type = int, help = "How many reports to send to every chat (Default: 3)", default = 3)
+parser.add_argument("--latency", type = float, help = "Seconds the fake API waits before answering each request (Default: 0.2)", default = 0.2)
+parser.add_argument("--fail-rate", type = float, help = "Fraction of messages the fake API fails (Default: 0.1)", default = 0.1)
+parser.add_argument("--threads", type = int, help = "How many delivery threads to use (Default: 8)", default = 8)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+#
+# Our retries are noisy, and expected here.
+#
+logging.getLogger().setLevel(logging.ERROR)
+
+chat_ids = [ str(-1000000000000 - i) for i in range(args.chats) ]
+reports = [ "Report {} of {}".format(i, args.reports) for i in range(args.reports) ]
+
+
+#
+# Send every report to every chat ourselves, one at a time, the way we used to.
+# Messages that fail are just lost.
+#
+def send_directly(url):
+
+	start = time.time()
+	sent = 0
+
+	for report in reports:
+		for chat_id in chat_ids:
+			r = requests.post(url + "/botTOKEN/sendMessage", json = {"chat_id": chat_id, "text": report})
+			if r.status_code == 200:
+				sent += 1
+
+	return(time.time() - start, sent)
+
+
+#
+# Queue every report for every chat, twice, plus a chat that doesn't exist.
+#
+def send_queued(url):
+
+	delivery = Delivery("TOKEN", api_url = url, num_threads = args.threads)
+
+	start = time.time()
+	for report in reports:
+		for i in range(2):
+			delivery.send(chat_ids + [ "missing" ], report)
+	queue_time = time.time() - start
+
+	delivery.flush()
+	delivery_time = time.time() - start
+	delivery.stop()
+
+	return(queue_time, delivery_time, delivery.stats)
+
+
+#
+# Check the messages our fake API accepted, and return a list of problems.
+#
+def check(messages):
+
+	retval = []
+
+	for chat_id in chat_ids:
+
+		got = [ message for message in messages if message["chat_id"] == chat_id ]
+
+		if sorted([ message["text"] for message in got ]) != sorted(reports):
+			retval.append("Chat {} got {}".format(chat_id, [ message["text"] for message in got ]))
+
+		times = [ message["time_t"] for message in got ]
+		gaps = [ b - a for a, b in zip(times, times[1:]) ]
+		if gaps and min(gaps) < 1:
+			retval.append("Chat {} got two messages {:.3f} seconds apart".format(chat_id, min(gaps)))
+
+	times = sorted([ message["time_t"] for message in messages ])
+	for index in range(len(times) - 30):
+		if times[index + 30] - times[index] < 1:
+			retval.append("Sent 31 messages in {:.3f} seconds".format(times[index + 30] - times[index]))
+			break
+
+	return(retval)
+
+
+telegram = fake_telegram.FakeTelegram(latency = args.latency)
+server = fake_telegram.start(telegram)
+(direct_time, direct_sent) = send_directly(server.url)
+
+telegram = fake_telegram.FakeTelegram(latency = args.latency, fail_rate = args.fail_rate)
+server = fake_telegram.start(telegram)
+(queue_time, delivery_time, stats) = send_queued(server.url)
+
+problems = check(telegram.get_messages())
+
+logging.getLogger().setLevel(logging.INFO)
+
+num_messages = len(chat_ids) * len(reports)
+logger.info("chats={} reports={} messages={} latency={} fail_rate={}".format(
+	len(chat_ids), len(reports), num_messages, args.latency, args.fail_rate))
+logger.info("direct: blocked_sec={:.2f} sent={}".format(direct_time, direct_sent))
+logger.info("queued: blocked_sec={:.4f} delivered_sec={:.2f} stats={} fake_api_errors={}".format(
+	queue_time, delivery_time, stats, telegram.get_stats()["errors"]))
+
+for problem in problems:
+	logger.error(problem)
+
+if problems:
+	sys.exit(1)
+
+logger.info("Every message was delivered once, within our rate limits.")
+
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# A local stand-in for the parts of Telegram's Bot API that we use, so that
+# message delivery can be tested and benchmarked without a real bot.
+#
+# Set telegram_api_url in config.ini to this server's URL to point 2-telegram-bot.py at it.
+#
+# Like Telegram, we answer with a 429 and a retry_after if a chat gets more than
+# one message a second, or if we get more than 30 messages a second overall.
+# We can also be told to fail some messages at random, and chat IDs that start
+# with "missing" get a 400, as if the bot isn't in that chat.
+#
+
+import argparse
+import http.server
+import json
+import logging as logger
+import logging.config
+import random
+import threading
+import time
+import urllib.parse
+
+
+#
+# This class holds the state of our fake API: the messages we've received,
+# and how many requests we've turned away.
+#
+class FakeTelegram:
+
+	#
+	# Seconds to wait before answering each request.
+	#
+	latency = 0
+
+	#
+	# The fraction of messages that get a 500 instead of being sent.
+	#
+	fail_rate = 0
+
+	#
+	# Telegram's limits.
+	#
+	messages_per_sec = 30
+	chat_interval = 1.0
+
+	#
+	# Each message we've accepted, as a dictionary of chat_id, text, and time_t.
+	#
+	messages = None
+
+	#
+	# How many requests we've answered with each error status.
+	#
+	errors = None
+
+	lock = None
+
+
+	def __init__(self, latency = 0, fail_rate = 0):
+		self.latency = latency
+		self.fail_rate = fail_rate
+		self.messages = []
+		self.errors = {}
+		self.lock = threading.Lock()
+
+
+	#
+	# Return a summary of what we've received.
+	#
+	def get_stats(self):
+
+		with self.lock:
+
+			chats = {}
+			for message in self.messages:
+				chats[message["chat_id"]] = chats.get(message["chat_id"], 0) + 1
+
+			retval = {
+				"messages": len(self.messages),
+				"chats": chats,
+				"errors": dict(self.errors),
+				}
+
+		return(retval)
+
+
+	#
+	# Return a copy of every message we've accepted.
+	#
+	def get_messages(self):
+		with self.lock:
+			return(list(self.messages))
+
+
+	#
+	# Record an error status and return it.
+	#
+	def error(self, status):
+		self.errors[status] = self.errors.get(status, 0) + 1
+		return(status)
+
+
+	#
+	# Try to send a message.
+	#
+	# Returns the HTTP status to answer with, which is 200 if the message was accepted.
+	#
+	def send_message(self, chat_id, text):
+
+		with self.lock:
+
+			if chat_id.startswith("missing"):
+				return(self.error(400))
+
+			if random.random() < self.fail_rate:
+				return(self.error(500))
+
+			now = time.time()
+
+			last = [ message for message in self.messages if message["chat_id"] == chat_id ][-1:]
+			if last and now - last[0]["time_t"] < self.chat_interval:
+				return(self.error(429))
+
+			recent = [ message for message in self.messages[-self.messages_per_sec:]
+				if now - message["time_t"] < 1 ]
+			if len(recent) >= self.messages_per_sec:
+				return(self.error(429))
+
+			self.messages.append({"chat_id": chat_id, "text": text, "time_t": now})
+
+		return(200)
+
+
+#
+# Our HTTP request handler. self.server.telegram is our FakeTelegram object.
+#
+class Handler(http.server.BaseHTTPRequestHandler):
+
+	def log_message(self, format, *args):
+		logger.debug("fake_telegram: " + format % args)
+
+
+	#
+	# Send a response as JSON.
+	#
+	def send_json(self, status, data):
+
+		body = json.dumps(data).encode("utf-8")
+
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	#
+	# Send a Bot API error, in the same format as Telegram.
+	#
+	def send_error_json(self, status, description, retry_after = None):
+
+		data = {"ok": False, "error_code": status, "description": description}
+		if retry_after:
+			data["parameters"] = {"retry_after": retry_after}
+
+		self.send_json(status, data)
+
+
+	def do_GET(self):
+		url = urllib.parse.urlparse(self.path)
+		self.handle_api(url.path, { key: value[0] for key, value in
+			urllib.parse.parse_qs(url.query).items() })
+
+
+	#
+	# The Bot API takes parameters as JSON or as a form.
+	#
+	def do_POST(self):
+
+		url = urllib.parse.urlparse(self.path)
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length).decode("utf-8")
+
+		if self.headers.get("Content-Type", "").startswith("application/json"):
+			params = json.loads(body or "{}")
+		else:
+			params = { key: value[0] for key, value in urllib.parse.parse_qs(body).items() }
+
+		self.handle_api(url.path, params)
+
+
+	#
+	# Answer a call to our API. Paths look like /bot<token>/<method>.
+	#
+	def handle_api(self, path, params):
+
+		telegram = self.server.telegram
+
+		if path == "/stats.json":
+			self.send_json(200, telegram.get_stats())
+			return
+
+		method = path.split("/")[-1]
+
+		if telegram.latency:
+			time.sleep(telegram.latency)
+
+		if method == "getMe":
+			self.send_json(200, {"ok": True, "result": {"id": 1, "is_bot": True,
+				"first_name": "fake_telegram", "username": "fake_telegram_bot"}})
+
+		#
+		# Nobody ever talks to us, so long polls just time out.
+		#
+		elif method == "getUpdates":
+			time.sleep(min(float(params.get("timeout", 0)), 10))
+			self.send_json(200, {"ok": True, "result": []})
+
+		elif method == "sendMessage":
+			chat_id = str(params["chat_id"])
+			status = telegram.send_message(chat_id, params["text"])
+
+			if status == 200:
+				self.send_json(200, {"ok": True, "result": {"message_id": 1, "date": int(time.time()),
+					"chat": {"id": chat_id, "type": "channel"}, "text": params["text"]}})
+			elif status == 429:
+				self.send_error_json(429, "Too Many Requests: retry after 1", retry_after = 1)
+			elif status == 400:
+				self.send_error_json(400, "Bad Request: chat not found")
+			else:
+				self.send_error_json(status, "Internal Server Error")
+
+		else:
+			self.send_error_json(404, "Not Found")
+
+
+#
+# Start our fake API in a background thread, and return the server.
+# The URL to use for telegram_api_url is in server.url.
+#
+def start(telegram, port = 0):
+
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+	server.daemon_threads = True
+	server.telegram = telegram
+	server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+	thread = threading.Thread(target = server.serve_forever, daemon = True)
+	thread.start()
+
+	return(server)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = "Run a fake Telegram Bot API for testing.")
+	parser.add_argument("--port", type = int, help = "Port to listen on (Default: 8081)", default = 8081)
+	parser.add_argument("--latency", type = float, help = "Seconds to wait before answering each request (Default: 0)", default = 0)
+	parser.add_argument("--fail-rate", type = float, help = "Fraction of messages to answer with a 500 (Default: 0)", default = 0)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+	server = start(FakeTelegram(latency = args.latency, fail_rate = args.fail_rate), port = args.port)
+	logger.info("Fake Telegram API listening at {}".format(server.url))
+
+	while True:
+		time.sleep(3600)
+
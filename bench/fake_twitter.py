@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# A local stand-in for the parts of Twitter's API that we use, so that
+# 1-fetch-tweets.py can be benchmarked without live credentials.
+#
+# Set twitter_api_url in config.ini to this server's URL to point the fetcher at it.
+#
+# Each user gets a synthetic timeline of tweets, one minute apart. Every third
+# tweet is a reply to another account's tweet, and every tenth one of those
+# original tweets "doesn't exist", so that backfill errors get exercised too.
+#
+
+import argparse
+import http.server
+import json
+import logging as logger
+import logging.config
+import re
+import threading
+import time
+import urllib.parse
+
+
+#
+# Tweet IDs for each user start here. Original tweets we replied to start at parent_base.
+#
+tweet_base = 10 ** 12
+parent_base = 10 ** 15
+
+#
+# When the newest tweet in each timeline was created.
+#
+start_time_t = 1546300800
+
+
+#
+# This class holds the state of our fake API: timelines, rate limits,
+# and a count of calls made to each endpoint.
+#
+class FakeTwitter:
+
+	#
+	# How many tweets each user has.
+	#
+	num_tweets = 0
+
+	#
+	# Seconds to wait before answering each request.
+	#
+	latency = 0
+
+	#
+	# Calls allowed per endpoint in each window, and the length of the window.
+	#
+	rate_limit = 0
+	rate_limit_window = 0
+
+	#
+	# Our rate limit windows per endpoint, and how many calls have been made.
+	#
+	windows = None
+	calls = None
+
+	#
+	# Each username we've seen, and the order we first saw it in.
+	# This keeps tweet IDs unique across users.
+	#
+	users = None
+
+	lock = None
+
+
+	def __init__(self, num_tweets = 10000, latency = 0, rate_limit = 900,
+		rate_limit_window = 900):
+
+		self.num_tweets = num_tweets
+		self.latency = latency
+		self.rate_limit = rate_limit
+		self.rate_limit_window = rate_limit_window
+		self.windows = {}
+		self.calls = {}
+		self.users = {}
+		self.lock = threading.Lock()
+
+
+	#
+	# Add new tweets to the top of every user's timeline.
+	#
+	def add_tweets(self, num):
+		with self.lock:
+			self.num_tweets += num
+
+
+	#
+	# Return a copy of how many calls have been made to each endpoint.
+	#
+	def get_calls(self):
+		with self.lock:
+			return(dict(self.calls))
+
+
+	#
+	# Record a call to an endpoint and return a tuple of whether it's allowed
+	# and the rate limit headers to send back.
+	#
+	def call(self, endpoint):
+
+		with self.lock:
+
+			self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+			now = time.time()
+			window = self.windows.get(endpoint)
+			if not window or window["reset"] <= now:
+				window = {"remaining": self.rate_limit,
+					"reset": int(now + self.rate_limit_window)}
+				self.windows[endpoint] = window
+
+			allowed = window["remaining"] > 0
+			if allowed:
+				window["remaining"] -= 1
+
+			headers = {
+				"x-rate-limit-limit": str(self.rate_limit),
+				"x-rate-limit-remaining": str(window["remaining"]),
+				"x-rate-limit-reset": str(window["reset"]),
+				}
+
+		return(allowed, headers)
+
+
+	#
+	# Return the first tweet ID of a user's timeline.
+	# Each user gets a range of a billion tweet IDs.
+	#
+	def get_user_base(self, username):
+
+		with self.lock:
+			if username not in self.users:
+				self.users[username] = len(self.users)
+
+			return(tweet_base + self.users[username] * 10 ** 9)
+
+
+	#
+	# Return a tweet from a user's timeline by its position, where 0 is the oldest.
+	#
+	def get_tweet(self, username, index):
+
+		tweet_id = self.get_user_base(username) + index
+		time_t = start_time_t - (self.num_tweets - index) * 60
+
+		retval = {
+			"id": tweet_id,
+			"text": "Tweet {} from {}".format(index, username),
+			"created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime(time_t)),
+			"user": {"screen_name": username},
+			"in_reply_to_status_id": None,
+			"in_reply_to_screen_name": None,
+			}
+
+		if index % 3 == 0:
+			retval["in_reply_to_status_id"] = parent_base + tweet_id - tweet_base
+			retval["in_reply_to_screen_name"] = "customer{}".format(index % 1000)
+
+		return(retval)
+
+
+	#
+	# Return an original tweet that one of our tweets replied to, or None if it "doesn't exist".
+	#
+	def get_parent(self, tweet_id):
+
+		index = (tweet_id - parent_base) % 10 ** 9
+		if tweet_id < parent_base or index % 30 == 0:
+			return(None)
+
+		time_t = start_time_t - (self.num_tweets - index) * 60 - 600
+
+		retval = {
+			"id": tweet_id,
+			"text": "Original tweet {}".format(index),
+			"created_at": time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime(time_t)),
+			"user": {"screen_name": "customer{}".format(index % 1000)},
+			}
+
+		return(retval)
+
+
+	#
+	# Return a page of a user's timeline, newest first, following Twitter's
+	# rules for count, max_id (inclusive) and since_id (exclusive).
+	#
+	def get_timeline(self, username, count, max_id = None, since_id = None):
+
+		retval = []
+
+		base = self.get_user_base(username)
+
+		high = self.num_tweets - 1
+		if max_id is not None:
+			high = min(high, max_id - base)
+
+		low = 0
+		if since_id is not None:
+			low = max(low, since_id - base + 1)
+
+		index = high
+		while index >= low and len(retval) < count:
+			retval.append(self.get_tweet(username, index))
+			index -= 1
+
+		return(retval)
+
+
+#
+# Our HTTP request handler. self.server.twitter is our FakeTwitter object.
+#
+class Handler(http.server.BaseHTTPRequestHandler):
+
+	def log_message(self, format, *args):
+		logger.debug("fake_twitter: " + format % args)
+
+
+	#
+	# Send a response as JSON.
+	#
+	def send_json(self, status, data, headers = {}):
+
+		body = json.dumps(data).encode("utf-8")
+
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		for key, value in headers.items():
+			self.send_header(key, value)
+		self.end_headers()
+		self.wfile.write(body)
+
+
+	def do_GET(self):
+		url = urllib.parse.urlparse(self.path)
+		self.handle_api(url.path, urllib.parse.parse_qs(url.query))
+
+
+	#
+	# Twython sends statuses/lookup as a POST with a form-encoded body.
+	#
+	def do_POST(self):
+		url = urllib.parse.urlparse(self.path)
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length).decode("utf-8")
+		self.handle_api(url.path, urllib.parse.parse_qs(body))
+
+
+	#
+	# Answer a call to our API.
+	#
+	# path - The path from the URL
+	# params - The request's parameters, as returned by parse_qs()
+	#
+	def handle_api(self, path, params):
+
+		twitter = self.server.twitter
+		params = { key: value[0] for key, value in params.items() }
+
+		if path == "/stats.json":
+			self.send_json(200, twitter.get_calls())
+			return
+
+		#
+		# Twython puts the ID of the tweet to show in the path.
+		#
+		match = re.match(r"^/1\.1/statuses/show/(\d+)\.json$", path)
+		if match:
+			params["id"] = match.group(1)
+			path = "/1.1/statuses/show.json"
+
+		endpoints = {
+			"/1.1/account/verify_credentials.json": "verify_credentials",
+			"/1.1/statuses/user_timeline.json": "user_timeline",
+			"/1.1/statuses/show.json": "show_status",
+			"/1.1/statuses/lookup.json": "lookup_status",
+			}
+
+		if path not in endpoints:
+			self.send_json(404, {"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]})
+			return
+
+		endpoint = endpoints[path]
+
+		if twitter.latency:
+			time.sleep(twitter.latency)
+
+		(allowed, headers) = twitter.call(endpoint)
+		if not allowed:
+			self.send_json(429, {"errors": [{"code": 88, "message": "Rate limit exceeded"}]},
+				headers)
+			return
+
+		if endpoint == "verify_credentials":
+			self.send_json(200, {"screen_name": "fake_twitter"}, headers)
+
+		elif endpoint == "user_timeline":
+			tweets = twitter.get_timeline(params["screen_name"], int(params.get("count", 20)),
+				max_id = int(params["max_id"]) if "max_id" in params else None,
+				since_id = int(params["since_id"]) if "since_id" in params else None)
+			self.send_json(200, tweets, headers)
+
+		elif endpoint == "show_status":
+			tweet = twitter.get_parent(int(params["id"]))
+			if tweet:
+				self.send_json(200, tweet, headers)
+			else:
+				self.send_json(404, {"errors": [{"code": 144,
+					"message": "No status found with that ID."}]}, headers)
+
+		elif endpoint == "lookup_status":
+			tweets = [ twitter.get_parent(int(id)) for id in params["id"].split(",") ]
+			self.send_json(200, [ tweet for tweet in tweets if tweet ], headers)
+
+
+#
+# Start our fake API in a background thread, and return the server.
+# The URL to use for twitter_api_url is in server.url.
+#
+def start(twitter, port = 0):
+
+	server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+	server.daemon_threads = True
+	server.twitter = twitter
+	server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+	thread = threading.Thread(target = server.serve_forever, daemon = True)
+	thread.start()
+
+	return(server)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description = "Run a fake Twitter API for benchmarking.")
+	parser.add_argument("--port", type = int, help = "Port to listen on (Default: 8080)", default = 8080)
+	parser.add_argument("--num", type = int, help = "How many tweets each user has (Default: 10000)", default = 10000)
+	parser.add_argument("--latency", type = float, help = "Seconds to wait before answering each request (Default: 0)", default = 0)
+	parser.add_argument("--rate-limit", type = int, help = "Calls allowed per endpoint per window (Default: 900)", default = 900)
+	parser.add_argument("--rate-limit-window", type = int, help = "Length of a rate limit window in seconds (Default: 900)", default = 900)
+	args = parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+	server = start(FakeTwitter(num_tweets = args.num, latency = args.latency,
+		rate_limit = args.rate_limit, rate_limit_window = args.rate_limit_window),
+		port = args.port)
+	logger.info("Fake Twitter API listening at {}".format(server.url))
+
+	while True:
+		time.sleep(3600)
+
+
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# End-to-end benchmark for 1-fetch-tweets.py, run against our fake Twitter API.
+#
+# This runs the fetcher in a scratch directory with its own config.ini and tweets.db
+# through three scenarios:
+#
+# - first-run: An empty database, fetching every user's history
+# - incremental: New tweets were posted since the last run
+# - backfill: Every reply needs its original tweet looked up again
+#
+# For each one we report tweets/sec, API calls per tweet, and time spent writing to the database.
+#
+# With --db-url, the fetcher writes to another database such as Postgres instead of tweets.db.
+# Our tables in it are dropped first, so it should be a scratch one.
+#
+
+import argparse
+import logging as logger
+import logging.config
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+import fake_twitter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))) + "/lib")
+from tables import Base
+
+
+parser = argparse.ArgumentParser(description = "Benchmark 1-fetch-tweets.py against a fake Twitter API.")
+parser.add_argument("--num", type = int, help = "How many tweets each user has (Default: 5000)", default = 5000)
+parser.add_argument("--users", type = int, help = "How many users to fetch (Default: 1)", default = 1)
+parser.add_argument("--new", type = int, help = "How many new tweets to add for the incremental run (Default: 500)", default = 500)
+parser.add_argument("--latency", type = float, help = "Seconds the fake API waits before answering each request (Default: 0.05)", default = 0.05)
+parser.add_argument("--rate-limit", type = int, help = "Calls allowed per endpoint per 15 minute window. Set this to 900 to see how the fetcher paces itself against Twitter's real limit. (Default: 100000)", default = 100000)
+parser.add_argument("--backfill-mode", choices = ["lookup", "show"], default = "lookup", help = "Passed on to the fetcher (Default: lookup)")
+parser.add_argument("--args", type = str, help = "Extra arguments to pass to the fetcher", default = "")
+parser.add_argument("--db-url", type = str, help = "Have the fetcher write to this database instead of tweets.db, such as postgresql://localhost/fetch_benchmark")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+#
+# Create our scratch directory with a config.ini pointing at the fake API.
+# The fetcher expects lib/ in its current directory, so link to ours.
+#
+def setup(url):
+
+	retval = tempfile.mkdtemp(prefix = "fetch-benchmark-")
+	os.symlink(repo + "/lib", retval + "/lib")
+
+	usernames = ",".join([ "user{}".format(i) for i in range(args.users) ])
+
+	with open(retval + "/config.ini", "w") as file:
+		file.write("[settings]\n")
+		file.write("twitter_app_key = key\n")
+		file.write("twitter_app_secret = secret\n")
+		file.write("twitter_final_oauth_token = token\n")
+		file.write("twitter_final_oauth_token_secret = secret\n")
+		file.write("twitter_username = {}\n".format(usernames))
+		file.write("twitter_api_url = {}\n".format(url))
+		file.write("database_url = {}\n".format(get_database_url(retval)))
+
+	return(retval)
+
+
+#
+# Return the URL of the database the fetcher writes to.
+#
+def get_database_url(dir):
+	return(args.db_url or "sqlite:///" + dir + "/tweets.db")
+
+
+#
+# Return the number of rows in a table in our scratch database.
+#
+def count(dir, table, where = "1 = 1"):
+
+	db = create_engine(get_database_url(dir))
+	retval = db.execute("SELECT COUNT(*) FROM {} WHERE {}".format(table, where)).scalar()
+	db.dispose()
+
+	return(retval)
+
+
+#
+# Run the fetcher once and report on how it did.
+#
+def run(name, dir, twitter, num):
+
+	calls_before = twitter.get_calls()
+	tweets_before = count(dir, "tweets") if db.has_table("tweets") else 0
+	backfilled_before = count(dir, "tweets",
+		"reply_time_t IS NOT NULL OR reply_error IS NOT NULL") if tweets_before else 0
+
+	cmd = [ sys.executable, repo + "/bin/1-fetch-tweets.py", "--config", dir + "/config.ini",
+		"--num", str(num), "--backfill-mode", args.backfill_mode ] + args.args.split()
+
+	start = time.time()
+	result = subprocess.run(cmd, cwd = dir, stdout = subprocess.PIPE,
+		stderr = subprocess.STDOUT, universal_newlines = True)
+	elapsed = time.time() - start
+
+	if result.returncode:
+		print(result.stdout)
+		raise Exception("Fetcher exited with {}".format(result.returncode))
+
+	calls_after = twitter.get_calls()
+	calls = { key: value - calls_before.get(key, 0) for key, value in calls_after.items() }
+	num_calls = sum(calls.values())
+
+	tweets = count(dir, "tweets") - tweets_before
+	backfilled = count(dir, "tweets",
+		"reply_time_t IS NOT NULL OR reply_error IS NOT NULL") - backfilled_before
+
+	#
+	# The fetcher logs how long it spent writing each batch of tweets,
+	# and how long each round of backfilling spent committing.
+	#
+	db_time = sum([ float(value) for value in re.findall(r"db_time=([\d.]+)", result.stdout) ])
+
+	logger.info("scenario={} elapsed={:.2f} tweets={} backfilled={} tweets_per_sec={:.0f} "
+		"api_calls={} api_calls_per_tweet={:.3f} db_time={:.3f} calls={}".format(
+		name, elapsed, tweets, backfilled, tweets / elapsed, num_calls,
+		num_calls / max(tweets + backfilled, 1), db_time, calls))
+
+
+twitter = fake_twitter.FakeTwitter(num_tweets = args.num, latency = args.latency,
+	rate_limit = args.rate_limit)
+server = fake_twitter.start(twitter)
+logger.info("Fake Twitter API listening at {}".format(server.url))
+
+dir = setup(server.url)
+logger.info("Scratch directory: {}".format(dir))
+
+db = create_engine(get_database_url(dir))
+Base.metadata.drop_all(db)
+
+run("first-run", dir, twitter, args.num)
+
+twitter.add_tweets(args.new)
+run("incremental", dir, twitter, args.num)
+
+with db.begin() as conn:
+	conn.execute("UPDATE tweets SET reply_time_t = NULL, reply_error = NULL, reply_age = 0 "
+		+ "WHERE reply_tweet_id IS NOT NULL")
+	conn.execute("DELETE FROM reply_parents")
+run("backfill", dir, twitter, 0)
+
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Micro-benchmark for parsing the timestamps on a page of 200 tweets,
+# comparing dateutil's parser against our fixed-format parser.
+#
+
+import argparse
+import logging as logger
+import logging.config
+import sys
+import time
+
+import dateutil.parser
+
+sys.path.append("lib")
+from timestamps import parse_twitter_time
+
+
+parser = argparse.ArgumentParser(description = "Benchmark parsing Twitter timestamps.")
+parser.add_argument("--pages", type = int, help = "How many pages of 200 tweets to parse (Default: 100)", default = 100)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+
+#
+# Create a page of 200 timestamps, one minute apart.
+#
+def get_page():
+
+	retval = []
+	start = 1539202764
+
+	for i in range(200):
+		retval.append(time.strftime("%a %b %d %H:%M:%S +0000 %Y", time.gmtime(start + i * 60)))
+
+	return(retval)
+
+
+#
+# Parse our page args.pages times and return the number of pages parsed per second.
+#
+def run(page, func):
+
+	start = time.time()
+	for i in range(args.pages):
+		for string in page:
+			func(string)
+
+	retval = args.pages / (time.time() - start)
+
+	return(retval)
+
+
+page = get_page()
+
+#
+# Make sure both parsers agree before timing them.
+#
+for string in page:
+	expected = int(dateutil.parser.parse(string).timestamp())
+	if parse_twitter_time(string) != expected:
+		raise Exception("Parsers disagree on '{}'".format(string))
+
+before = run(page, lambda string: int(dateutil.parser.parse(string).timestamp()))
+after = run(page, parse_twitter_time)
+
+logger.info("dateutil: pages_per_sec={:.1f} timestamps_per_sec={:.0f}".format(before, before * 200))
+logger.info("parse_twitter_time: pages_per_sec={:.1f} timestamps_per_sec={:.0f}".format(after, after * 200))
+logger.info("speedup={:.1f}x".format(after / before))
+
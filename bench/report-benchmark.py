@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Benchmark the queries behind a Telegram report against a large tweets.db.
+#
+# The database is generated on the first run (a few million rows spread across
+# a handful of users, one tweet every few minutes) and reused after that.
+#
+# For each window we time three ways of building a report:
+#
+# - before: The separate queries that the report used to run, including
+#	loading every reply age to find the median
+# - single-pass: get_window_stats() and get_reply_percentiles()
+# - rollups: get_rollup_stats(), which the report uses with --no-memory-cache
+# - columnar: Our in-memory copy of the tweets, which the report uses by default
+#
+# Then we time a report covering every window at once, as one call to
+# get_rollup_stats_windows() against one get_rollup_stats() per window.
+#
+# With --db-url, another database such as Postgres is used instead of a SQLite file,
+# and generated the same way if it has no tweets in it.
+#
+
+import argparse
+import datetime
+import logging as logger
+import logging.config
+import random
+import sqlite3
+import sys
+import time
+
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import func
+
+sys.path.append("lib")
+from queries import filter_replies, filter_window, get_last_tweet, get_reply_percentiles, get_window_stats
+from columnar import ColumnarCache
+from rollups import get_rollup_stats, get_rollup_stats_windows, migrate_rollups
+from tables import create_all, get_engine, Tweets
+
+
+parser = argparse.ArgumentParser(description = "Benchmark the queries behind a Telegram report.")
+parser.add_argument("--db", type = str, help = "Database to benchmark against, created if it doesn't exist (Default: /tmp/report-benchmark.db)", default = "/tmp/report-benchmark.db")
+parser.add_argument("--db-url", type = str, help = "Benchmark this database instead of a SQLite file, such as postgresql://localhost/report_benchmark")
+parser.add_argument("--rows", type = int, help = "How many tweets to generate (Default: 3000000)", default = 3000000)
+parser.add_argument("--users", type = int, help = "How many users to spread the tweets across (Default: 4)", default = 4)
+parser.add_argument("--runs", type = int, help = "How many times to run each report (Default: 5)", default = 5)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+#
+# Windows to report on, as seconds before the newest tweet.
+#
+windows = {
+	"1d": 86400,
+	"7d": 7 * 86400,
+	"30d": 30 * 86400,
+	"365d": 365 * 86400,
+	}
+
+#
+# When the newest tweet was created.
+#
+end_time_t = 1546300800
+
+
+#
+# Fill our database with tweets.
+#
+# Every third tweet is a reply, and most of those have had their reply age backfilled.
+#
+def generate(db):
+
+	logger.info("Generating {} rows in {}...".format(args.rows, repr(db.url)))
+
+	random.seed(1)
+
+	def get_rows():
+		for i in range(args.rows):
+
+			username = "user{}".format(i % args.users)
+			time_t = end_time_t - (args.rows - i) * 180 // args.users
+			tweet_id = 10 ** 12 + i
+			reply_tweet_id = None
+			reply_age = 0
+			reply_time_t = None
+
+			if i % 3 == 0:
+				reply_tweet_id = 10 ** 15 + i
+				if i % 30:
+					reply_age = random.randint(30, 86400)
+					reply_time_t = time_t - reply_age
+
+			yield({"tweet_id": tweet_id, "username": username, "time_t": time_t,
+				"date": datetime.datetime.utcfromtimestamp(time_t), "text": "Tweet {}".format(i),
+				"reply_tweet_id": reply_tweet_id, "reply_age": reply_age, "reply_time_t": reply_time_t})
+
+	start = time.time()
+
+	#
+	# SQLite is much quicker to fill without SQLAlchemy in the way.
+	#
+	if db.dialect.name == "sqlite":
+		conn = sqlite3.connect(db.url.database)
+		conn.executemany("INSERT INTO tweets (tweet_id, username, time_t, date, text, "
+			+ "reply_tweet_id, reply_age, reply_time_t) VALUES (:tweet_id, :username, :time_t, "
+			+ ":date, :text, :reply_tweet_id, :reply_age, :reply_time_t)",
+			( dict(row, date = str(row["date"]) + ".000000") for row in get_rows() ))
+		conn.commit()
+		conn.execute("ANALYZE")
+		conn.close()
+
+	else:
+		rows = []
+		for row in get_rows():
+			rows.append(row)
+			if len(rows) == 10000:
+				db.execute(Tweets.__table__.insert(), rows)
+				rows = []
+		if rows:
+			db.execute(Tweets.__table__.insert(), rows)
+		db.execute("ANALYZE")
+
+	logger.info("Generated {} rows in {:.1f} seconds".format(args.rows, time.time() - start))
+
+
+#
+# The queries the report ran before get_window_stats(): two counts,
+# the last tweet, the min, max and average reply ages, and then
+# every reply age in order so that we could pick out the median.
+#
+def report_before(session, username, start_time_t):
+
+	retval = {}
+
+	retval["num_tweets"] = filter_window(session.query(
+		func.count(Tweets.tweet_id).label("cnt")), username, start_time_t).first().cnt
+	retval["num_tweets_reply"] = filter_window(session.query(
+		func.count(Tweets.tweet_id).label("cnt")), username, start_time_t).filter(
+		Tweets.reply_tweet_id != None).first().cnt
+	retval["last_tweet"] = get_last_tweet(session, username)
+
+	retval["min_reply_age"] = filter_replies(filter_window(session.query(
+		func.min(Tweets.reply_age).label("min")), username, start_time_t)).first().min
+	retval["max_reply_age"] = filter_replies(filter_window(session.query(
+		func.max(Tweets.reply_age).label("max")), username, start_time_t)).first().max
+	retval["avg_reply_age"] = filter_replies(filter_window(session.query(
+		func.avg(Tweets.reply_age).label("avg")), username, start_time_t)).first().avg
+
+	times = [ row.reply_age for row in filter_replies(filter_window(
+		session.query(Tweets.reply_age), username, start_time_t)).order_by(Tweets.reply_age) ]
+	if len(times) % 2:
+		retval["median_reply_age"] = times[len(times) // 2]
+	else:
+		retval["median_reply_age"] = (times[len(times) // 2 - 1] + times[len(times) // 2]) / 2
+
+	#
+	# The reply ages on either side of the median, for checking estimates against.
+	#
+	retval["median_range"] = (times[(len(times) - 1) // 2], times[len(times) // 2])
+
+	return(retval)
+
+
+#
+# A single pass over the tweets in our window, and then the percentiles.
+#
+def report_single_pass(session, username, start_time_t):
+
+	retval = get_window_stats(session, username, start_time_t)
+	retval["last_tweet"] = get_last_tweet(session, username)
+
+	percentiles = get_reply_percentiles(session, username, start_time_t,
+		[ 50, 90, 99 ], retval["num_tweets_reply_timed"])
+	retval["median_reply_age"] = percentiles[50]
+
+	return(retval)
+
+
+#
+# Add up the rollups in our window, and estimate the percentiles from their sketches.
+#
+def report_rollups(session, username, start_time_t):
+
+	retval = get_rollup_stats(session, username, start_time_t)
+	retval["last_tweet"] = get_last_tweet(session, username)
+	retval["median_reply_age"] = retval["sketch"].get_percentile(50)
+
+	return(retval)
+
+
+#
+# Work out our stats from our in-memory copy of the tweets.
+#
+def report_columnar(session, username, start_time_t):
+
+	retval = columnar.get_stats(session, username, [ start_time_t ])[start_time_t]
+	retval["last_tweet"] = get_last_tweet(session, username)
+	retval["median_reply_age"] = retval["sketch"].get_percentile(50)
+
+	return(retval)
+
+
+#
+# Run a report for every user a few times, and return the fastest run in seconds.
+#
+def time_report(session, report, start_time_t):
+
+	retval = None
+
+	for i in range(args.runs):
+
+		start = time.time()
+		for user in range(args.users):
+			report(session, "user{}".format(user), start_time_t)
+		elapsed = time.time() - start
+
+		if retval is None or elapsed < retval:
+			retval = elapsed
+
+	return(retval)
+
+
+url = args.db_url or "sqlite:///" + args.db
+
+db = get_engine(url)
+create_all(db)
+session = sessionmaker(bind = db)()
+
+num_rows = session.query(func.count(Tweets.id)).scalar()
+if not num_rows:
+	session.close()
+	generate(db)
+	num_rows = session.query(func.count(Tweets.id)).scalar()
+
+migrate_rollups(session)
+
+logger.info("Benchmarking against {} rows in {}".format(num_rows, repr(db.url)))
+
+columnar = ColumnarCache()
+columnar.refresh(session)
+
+for name, seconds in windows.items():
+
+	start_time_t = end_time_t - seconds
+
+	#
+	# Make sure every version agrees before we time them.
+	# The median from our rollups is an estimate, so it only has to be
+	# within 1% of one of the reply ages on either side of the median.
+	#
+	before = report_before(session, "user0", start_time_t)
+	for report in [ report_single_pass, report_rollups, report_columnar ]:
+		after = report(session, "user0", start_time_t)
+		for key in ["num_tweets", "num_tweets_reply", "min_reply_age", "max_reply_age", "median_reply_age"]:
+			if key == "median_reply_age" and report == report_rollups:
+				(low, high) = before["median_range"]
+				if low * 0.99 <= after[key] <= high * 1.01:
+					continue
+			if before[key] != after[key]:
+				raise Exception("Mismatch in {} for window {} from {}: {} != {}".format(
+					key, name, report.__name__, before[key], after[key]))
+
+	time_before = time_report(session, report_before, start_time_t)
+	time_single_pass = time_report(session, report_single_pass, start_time_t)
+	time_rollups = time_report(session, report_rollups, start_time_t)
+	time_columnar = time_report(session, report_columnar, start_time_t)
+
+	logger.info("window={} tweets_per_user={} before_ms={:.2f} single_pass_ms={:.2f} rollups_ms={:.2f} "
+		"columnar_ms={:.2f} rollups_speedup={:.2f}x columnar_speedup={:.2f}x".format(
+		name, after["num_tweets"], time_before * 1000 / args.users,
+		time_single_pass * 1000 / args.users, time_rollups * 1000 / args.users,
+		time_columnar * 1000 / args.users, time_before / time_rollups, time_before / time_columnar))
+
+
+#
+# Time a report covering all of our windows, window by window and then in one pass.
+#
+start_times = [ end_time_t - seconds for seconds in windows.values() ]
+
+def report_each_window(session, username, start_time_t):
+	return([ get_rollup_stats(session, username, start_time_t) for start_time_t in start_times ])
+
+def report_all_windows(session, username, start_time_t):
+	return(get_rollup_stats_windows(session, username, start_times))
+
+time_each = time_report(session, report_each_window, None)
+time_all = time_report(session, report_all_windows, None)
+
+logger.info("windows={} each_window_ms={:.2f} one_pass_ms={:.2f} speedup={:.2f}x".format(
+	",".join(windows.keys()), time_each * 1000 / args.users, time_all * 1000 / args.users,
+	time_each / time_all))
+
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Vim: :set softtabstop=0 noexpandtab tabstop=4
+#
+# Measure how long each of our entry points takes to start up, and how much memory it uses.
+#
+# Each script is run in a scratch directory with its own config.ini and tweets.db,
+# pointed at our fake Twitter and Telegram APIs, and we watch its output for two things:
+#
+# - Its first line of output, which comes once its imports are done and its
+#	arguments are parsed. The memory it's using by then is its import RSS.
+# - A line that shows it has started doing useful work, such as prompting for
+#	credentials or sending its first report. That's its time to first useful work.
+#
+# We stop each script once it gets there. Each one has a budget for time to first
+# useful work and for import RSS, and we exit with an error if any of them go over.
+#
+
+import argparse
+import logging as logger
+import logging.config
+import os
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_telegram
+import fake_twitter
+
+
+parser = argparse.ArgumentParser(description = "Measure the startup time and import RSS of each of our entry points.")
+parser.add_argument("--runs", type = int, help = "How many times to run each script. We report the median. (Default: 3)", default = 3)
+parser.add_argument("--timeout", type = float, help = "How many seconds to give each script (Default: 30)", default = 30)
+parser.add_argument("--no-budget", action = "store_true", help = "Report our numbers without checking them against our budgets")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
+
+repo = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+#
+# Our entry points, with their arguments, what to type at their prompts,
+# the output that means they're doing useful work, and their budgets
+# for seconds to get there and MB of RSS after their imports.
+#
+entry_points = [
+	{
+		"name": "0-get-credentials",
+		"args": [],
+		"input": "n\n" * 6,
+		"marker": "Configure Twitter app?",
+		"budget_secs": 0.5,
+		"budget_mb": 20,
+	},
+	{
+		"name": "1-export-to-json",
+		"args": [ "--output", "tweets.json" ],
+		"input": "",
+		"marker": "Wrote ",
+		"budget_secs": 1.0,
+		"budget_mb": 40,
+	},
+	{
+		"name": "1-fetch-tweets",
+		"args": [ "--num", "200" ],
+		"input": "",
+		"marker": "Fetching tweets for",
+		"budget_secs": 1.5,
+		"budget_mb": 60,
+	},
+	{
+		"name": "2-telegram-bot",
+		"args": [ "--interval", "3600" ],
+		"input": "",
+		"marker": "Message queued for",
+		"budget_secs": 1.5,
+		"budget_mb": 50,
+	},
+	]
+
+
+#
+# Create our scratch directory, with copies of our scripts so that
+# they find our config.ini instead of the one at the top of the repo.
+#
+def setup(twitter_url, telegram_url):
+
+	retval = tempfile.mkdtemp(prefix = "startup-")
+	os.symlink(repo + "/lib", retval + "/lib")
+
+	os.mkdir(retval + "/bin")
+	for entry_point in entry_points:
+		shutil.copy(repo + "/bin/" + entry_point["name"] + ".py", retval + "/bin")
+
+	with open(retval + "/config.ini", "w") as file:
+		file.write("[settings]\n")
+		file.write("twitter_app_key = key\n")
+		file.write("twitter_app_secret = secret\n")
+		file.write("twitter_final_oauth_token = token\n")
+		file.write("twitter_final_oauth_token_secret = secret\n")
+		file.write("twitter_username = user0\n")
+		file.write("twitter_api_url = {}\n".format(twitter_url))
+		file.write("telegram_bot_token = token\n")
+		file.write("telegram_chat_id = 1\n")
+		file.write("telegram_api_url = {}\n".format(telegram_url))
+
+	return(retval)
+
+
+#
+# Return the resident memory of a process in MB, or None if we can't tell.
+#
+def get_rss(pid):
+
+	try:
+		with open("/proc/{}/status".format(pid)) as file:
+			for line in file:
+				if line.startswith("VmRSS:"):
+					return(int(line.split()[1]) / 1024)
+	except (FileNotFoundError, ProcessLookupError):
+		pass
+
+	return(None)
+
+
+#
+# Run a script once, and stop it once it starts doing useful work.
+#
+# Returns a dictionary of how long it took to finish its imports and to start
+# doing useful work, and its RSS at the first of those, or None if it never got there.
+#
+def run(dir, entry_point):
+
+	retval = {}
+
+	start = time.time()
+	process = subprocess.Popen([ sys.executable, "-u", "bin/" + entry_point["name"] + ".py" ] + entry_point["args"],
+		cwd = dir, stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+	process.stdin.write(entry_point["input"].encode("utf-8"))
+	process.stdin.flush()
+
+	output = b""
+	while time.time() < start + args.timeout:
+
+		(readable, writable, errored) = select.select([ process.stdout ], [], [], 0.01)
+		if not readable:
+			continue
+
+		data = os.read(process.stdout.fileno(), 65536)
+		if not data:
+			break
+		output += data
+
+		if "import_secs" not in retval:
+			retval["import_secs"] = time.time() - start
+			retval["import_mb"] = get_rss(process.pid)
+
+		if entry_point["marker"].encode("utf-8") in output:
+			retval["work_secs"] = time.time() - start
+			break
+
+	process.kill()
+	process.wait()
+
+	if "work_secs" not in retval:
+		logger.error("{} never got to \"{}\". Its last output was:\n{}".format(entry_point["name"],
+			entry_point["marker"], "\n".join(output.decode("utf-8", "replace").splitlines()[-10:])))
+		return(None)
+
+	return(retval)
+
+
+#
+# Return the median of a list.
+#
+def median(values):
+	values = sorted(values)
+	return(values[len(values) // 2])
+
+
+twitter_server = fake_twitter.start(fake_twitter.FakeTwitter(num_tweets = 1000))
+telegram_server = fake_telegram.start(fake_telegram.FakeTelegram())
+dir = setup(twitter_server.url, telegram_server.url)
+
+logger.info("Running each entry point {} times in {}".format(args.runs, dir))
+
+problems = []
+
+for entry_point in entry_points:
+
+	#
+	# The first run creates our database, so it's not counted.
+	#
+	run(dir, entry_point)
+	runs = [ run(dir, entry_point) for i in range(args.runs) ]
+
+	if None in runs:
+		problems.append("{} failed to start".format(entry_point["name"]))
+		continue
+
+	result = { key: median([ run[key] for run in runs ]) for key in runs[0] }
+
+	logger.info("entry_point={} import_secs={:.3f} import_mb={:.1f} first_work_secs={:.3f} budget_secs={} budget_mb={}".format(
+		entry_point["name"], result["import_secs"], result["import_mb"] or 0, result["work_secs"],
+		entry_point["budget_secs"], entry_point["budget_mb"]))
+
+	if result["work_secs"] > entry_point["budget_secs"]:
+		problems.append("{} took {:.3f} seconds to start doing useful work, over its budget of {}".format(
+			entry_point["name"], result["work_secs"], entry_point["budget_secs"]))
+
+	if result["import_mb"] and result["import_mb"] > entry_point["budget_mb"]:
+		problems.append("{} was using {:.1f} MB after its imports, over its budget of {}".format(
+			entry_point["name"], result["import_mb"], entry_point["budget_mb"]))
+
+shutil.rmtree(dir)
+
+for problem in problems:
+	logger.error(problem)
+
+if problems and not args.no_budget:
+	sys.exit(1)
+
@@ -16,11 +16,10 @@ import time
 from urllib.parse import urlparse
 import webbrowser
 
-import boto3
-import humanize
-import telegram
-import twython
-
+#
+# Twython, boto3, humanize, and telegram are imported by the steps that use them,
+# so answering "n" to a step doesn't cost us the time it takes to load its library.
+#
 
 sys.path.append("lib")
 import config as configParser
@@ -48,6 +47,8 @@ else:
 #
 def getTwitterAuthData(config):
 
+	import twython
+
 	retval = {}
 
 	print("# ")
@@ -72,7 +73,7 @@ def getTwitterAuthData(config):
 		"Enter your Consumer API Secret Key here")
 
 	retval["twitter_username"] = config.get_input("twitter_username", 
-		"Username you want to get Tweet stats on")
+		"Username you want to get Tweet stats on (separate several with commas)")
 
 	twitter = twython.Twython(retval["twitter_app_key"], retval["twitter_app_secret"])
 	auth = twitter.get_authentication_tokens()
@@ -133,6 +134,7 @@ def getLastUpdated(config, key):
 	if not last:
 		return("Never")
 
+	import humanize
 	retval = humanize.naturaltime(time.time() - int(last))
 
 	return(retval)
@@ -161,6 +163,7 @@ def configureTwitter(config):
 		return
 
 	logger.info("Verifying Twitter credentials...")
+	import twython
 	twitter = twython.Twython(config.get("twitter_app_key"), 
 		config.get("twitter_app_secret"), 
 		config.get("twitter_final_oauth_token"), 
@@ -208,6 +211,7 @@ def configureAWS(config):
 		return
 
 	logger.info("Verifying AWS credentials...")
+	import boto3
 
 	s3 = boto3.client("s3",
 		aws_access_key_id = config.get("aws_access_key_id"),
@@ -232,7 +236,7 @@ def configureTelegram(config):
 
 	if choice:
 		config.get_input("telegram_bot_token", "Enter your Telegram Bot token")
-		config.get_input("telegram_chat_id", "Enter your Telegram chat ID")
+		config.get_input("telegram_chat_id", "Enter your Telegram chat ID (separate several with commas)")
 		config.set("telegram_created", int(time.time()))
 		config.write_config()
 		verify = True
@@ -243,6 +247,7 @@ def configureTelegram(config):
 	if not verify:
 		return
 
+	import telegram
 	bot = telegram.Bot(config.get("telegram_bot_token"))
 
 	try:
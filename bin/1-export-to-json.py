@@ -4,33 +4,34 @@
 # Dump our tweets as JSON-formatted data
 #
 
+import argparse
 import logging as logger
 import logging.config
+import os
 import sys
-import time
-import traceback
-import webbrowser
-
-import dateutil.parser
-import twython
 
 sys.path.append("lib")
-from sqlalchemy.sql.expression import func
-from tables import create_all, get_session, Tweets
+import config as configParser
+from tables import get_database_url, get_session, Tweets
+
+parser = argparse.ArgumentParser(description = "Export our tweets as JSON, one tweet per line.")
+parser.add_argument("--output", type = str, help = "File to write to (Default: /mnt/tweets.json)", default = "/mnt/tweets.json")
+args = parser.parse_args()
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
 
 #
 # Open our file for output
 #
-output = "/mnt/tweets.json"
+output = args.output
 logger.info("Writing to file '{}'...".format(output))
 f = open(output, "w")
 
 #
 # Connect to the database
 #
-session = get_session()
+ini_file = os.path.dirname(os.path.realpath(__file__)) + "/../config.ini"
+session = get_session(url = get_database_url(configParser.Config(ini_file)))
 
 #
 # Grab all Tweets and export them
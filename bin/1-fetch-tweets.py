@@ -3,36 +3,54 @@
 
 
 import argparse
+import atexit
+import concurrent.futures
 import configparser
 import datetime
 import json
 import logging as logger
 import logging.config
 import os
+import queue
 import sys
+import threading
 import time
 import traceback
 import webbrowser
 
-import dateutil.parser
 import twython
 
 sys.path.append("lib")
 import config as configParser
-from sqlalchemy.sql.expression import func
-from tables import create_all, get_session, Tweets
+from archive import Archive, read_archive
+from notify import notify
+from ratelimit import RateLimiter
+from rollups import migrate_rollups, update_rollups
+from queries import filter_backfill, filter_reply_error, get_max_tweet_id, get_min_tweet_id
+from tables import checkpoint, create_all, get_database_url, get_session, insert_ignore, FetchState, ReplyParents, Tweets
+from timestamps import parse_twitter_time
 
 
 #
 # Parse our arguments
 #
-parser = argparse.ArgumentParser(description = "Download twitter timeline for a user. Their timeline will be traversed in reverse order and pick up where old fetches left off.")
+parser = argparse.ArgumentParser(description = "Download twitter timelines for one or more users. Their timelines will be traversed in reverse order and pick up where old fetches left off.")
 parser.add_argument("--debug", action = "store_true")
+parser.add_argument("--config", type = str, help = "Path to our config file (Default: config.ini in the top of the repo)",
+	default = os.path.dirname(os.path.realpath(__file__)) + "/../config.ini")
 parser.add_argument("--num", type = int, help = "How many tweets to fetch in total (set this to a large number on the first run! Default: 500)", default = 500)
-parser.add_argument("--loop", type = int, help = "Loop after sleeping for N seconds")
+parser.add_argument("--loop", type = int, help = "Loop after sleeping for N seconds. If there are still old tweets left to fetch, we loop again as soon as the rate limit allows.")
+parser.add_argument("--threads", type = int, help = "How many accounts to fetch at once, when twitter_username in config.ini lists several accounts. (Default: 4)", default = 4)
+parser.add_argument("--backfill-mode", choices = ["lookup", "show"], default = "lookup", help = "How to backfill replies. \"lookup\" fetches up to 100 original tweets per API call, \"show\" fetches them one at a time. (Default: lookup)")
+parser.add_argument("--negative-cache-ttl", type = int, help = "How many seconds to remember original tweets that couldn't be fetched (suspended, deleted, etc.). After that, the replies to them are backfilled again. (Default: forever)")
+parser.add_argument("--archive", type = str, help = "Directory to archive raw API responses to, as compressed JSON lines. This lets tweets be reprocessed later without fetching them again.")
+parser.add_argument("--reprocess", action = "store_true", help = "Instead of fetching from Twitter, load every tweet in the --archive directory into the database and exit. No API calls are made.")
 parser.add_argument("--ignore-max-tweet-id", action = "store_true", help = "Used for development.  Set this to ignore the max tweet ID. This will cause all tweets to be fetched.")
 args = parser.parse_args()
 
+if args.reprocess and not args.archive:
+	parser.error("--reprocess needs an --archive directory to read from")
+
 #
 # Set up the logger
 #
@@ -42,9 +60,30 @@ else:
 	logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(levelname)s: %(message)s')
 
 #
-# Connect to the database
+# Connect to the database.
+# This is a scoped session, so each of our fetching threads gets its own.
+#
+session = get_session(scoped = True, url = get_database_url(configParser.Config(args.config)))
+migrate_rollups(session)
+
+#
+# Keep track of our rate limits across all of our API calls.
+# This is shared between threads, so all accounts draw from the same budget.
+#
+limiter = RateLimiter()
+
+#
+# Our Twitter object, once our credentials have been verified.
+#
+twitter = None
+
+#
+# Where we archive raw API responses, if anywhere.
 #
-session = get_session()
+archive = None
+if args.archive and not args.reprocess:
+	archive = Archive(args.archive)
+	atexit.register(archive.close)
 
 
 #
@@ -60,7 +99,7 @@ def parseTweets(tweets):
 		tweet_id = row["id"]
 		tweet = row["text"]
 		user = row["user"]["screen_name"]
-		timestamp = int(dateutil.parser.parse(row["created_at"]).timestamp())
+		timestamp = parse_twitter_time(row["created_at"])
 		date = datetime.datetime.fromtimestamp(timestamp)
 		date_formatted = date.strftime("%Y-%m-%d %H:%M:%S")
 		url = "https://twitter.com/%s/status/%s" % (user, tweet_id)
@@ -92,28 +131,64 @@ def parseTweets(tweets):
 
 
 #
-# Write our tweets to the database
+# Write our tweets to the database.
 #
-def write_tweets(tweets):
-
-	for tweet in tweets:
-		row = Tweets(username = tweet["username"], date = tweet["date"],
-			time_t = tweet["time_t"], tweet_id = tweet["id"], 
-			text = tweet["text"],
-			url =tweet["url"], reply_age = 0, 
-			reply_tweet_id = tweet["reply_tweet_id"])
-
-		if "reply_username" in tweet:
-			row.reply_username = tweet["reply_username"]
+# The entire page is written with a single executemany() in one transaction,
+# so we pay for one commit per page instead of one commit per tweet.
+# Tweets we already have are skipped by the unique index on tweet_id,
+# so fetching an overlapping range again is harmless.
+#
+# The rollups for the hours these tweets fall in are updated in the same transaction,
+# and once it's committed, the Telegram bot is told about any new tweets.
+#
+# state - Optional FetchState row. Any changes made to it are committed
+#	in the same transaction as the tweets.
+#
+def write_tweets(tweets, state = None):
 
-		session.add(row)
-		session.commit()
+	if not len(tweets):
+		return
 
-	logger.info("Wrote {} tweets to the database!".format(len(tweets)))
+	rows = []
+	for tweet in tweets:
+		rows.append({
+			"username": tweet["username"],
+			"date": tweet["date"],
+			"time_t": tweet["time_t"],
+			"tweet_id": tweet["id"],
+			"text": tweet["text"],
+			"url": tweet["url"],
+			"reply_age": 0,
+			"reply_tweet_id": tweet["reply_tweet_id"],
+			"reply_username": tweet.get("reply_username"),
+			})
+
+	start = time.time()
+	result = session.execute(insert_ignore(session, Tweets.__table__), rows)
+	if result.rowcount:
+		update_rollups(session, [ (row["username"], row["time_t"]) for row in rows ])
+	if state:
+		if result.rowcount:
+			state.touch()
+		else:
+			state.updated_time_t = int(time.time())
+		session.add(state)
+	session.commit()
+	db_time = time.time() - start
+
+	if result.rowcount:
+		notify([ row["username"] for row in rows ])
+
+	rows_per_sec = 0
+	if db_time:
+		rows_per_sec = round(len(rows) / db_time)
+
+	logger.info("Wrote {} tweets to the database! new={} db_time={:.3f} rows_per_sec={}".format(
+		len(rows), result.rowcount, db_time, rows_per_sec))
 
 
 #
-# Fetch a number of tweets from Twitter.
+# Fetch a number of tweets from Twitter, without parsing them.
 #
 # @param object twitter - Our Twitter oject
 # @param string username - The username we're looking for tweets from
@@ -121,18 +196,17 @@ def write_tweets(tweets):
 # @param kwarg max_id - Return tweets less than or equal to this ID. Used when paging through old tweets.
 # @param kwarg min_id - Return tweets after this ID. Used when looking for new tweets.
 #
-# @return A dictionary that includes tweets that aren't RTs, the count, and the last ID.
+# @return A list of tweets as returned by Twitter's API.
 #
-def getTweets(twitter, username, count, **kwargs):
+def fetchTweets(twitter, username, count, **kwargs):
 
 	if not "min_id" in kwargs:
 		kwargs["min_id"] = None
 	if not "max_id" in kwargs:
 		kwargs["max_id"] = None
 
-	retval = {"tweets": [], "count": 0, "min_id": -1}
 	logger.info(
-		"getTweets(): username=%s, count=%d, min_id=%s, max_id=%s" % (
+		"fetchTweets(): username=%s, count=%d, min_id=%s, max_id=%s" % (
 		username, count, kwargs["min_id"], kwargs["max_id"]))
 	
 	#
@@ -145,23 +219,55 @@ def getTweets(twitter, username, count, **kwargs):
 	#
 	if kwargs["min_id"] is None and kwargs["max_id"] is None:
 		logger.info("No since_id or max_id, fetch just one tweet to prime our table.")
-		tweets = twitter.get_user_timeline(screen_name = username, count = count, 
+		tweets = limiter.call(twitter, "user_timeline", twitter.get_user_timeline,
+			screen_name = username, count = count,
+			include_rts = False)
+
+	elif kwargs["min_id"] is not None and kwargs["max_id"] is not None:
+		logger.info("A min_id of {} and max_id of {} were specified, fetching {} tweets between them".format(
+			kwargs["min_id"], kwargs["max_id"], count))
+		tweets = limiter.call(twitter, "user_timeline", twitter.get_user_timeline,
+			screen_name = username, count = count,
+			since_id = kwargs["min_id"], max_id = kwargs["max_id"] - 1,
 			include_rts = False)
 
 	elif kwargs["max_id"] is not None:
 		logger.info("A max_id of {} was specified, fetching {} tweets before that".format(
 			kwargs["max_id"], count))
-		tweets = twitter.get_user_timeline(screen_name = username, count = count, 
+		tweets = limiter.call(twitter, "user_timeline", twitter.get_user_timeline,
+			screen_name = username, count = count,
 			max_id = kwargs["max_id"] - 1,
 			include_rts = False)
 
 	elif kwargs["min_id"] is not None:
 		logger.info("A min_id of {} was specified, fetching {} tweets after that".format(
 			kwargs["min_id"], count))
-		tweets = twitter.get_user_timeline(screen_name = username, count = count, 
+		tweets = limiter.call(twitter, "user_timeline", twitter.get_user_timeline,
+			screen_name = username, count = count,
 			since_id = kwargs["min_id"],
 			include_rts = False)
 
+	rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
+	logger.info("twitter_search_rate_limit_left=" + rate_limit)
+
+	if archive:
+		archive.write_timeline(username, tweets)
+
+	return(tweets)
+
+
+#
+# Fetch a number of tweets from Twitter and parse them.
+# Takes the same arguments as fetchTweets().
+#
+# @return A dictionary that includes tweets that aren't RTs, the count, and the last ID.
+#
+def getTweets(twitter, username, count, **kwargs):
+
+	retval = {"tweets": [], "count": 0, "min_id": -1}
+
+	tweets = fetchTweets(twitter, username, count, **kwargs)
+
 	#
 	# Parse our tweets to get values we care about, and return some metadata as well.
 	#
@@ -170,9 +276,6 @@ def getTweets(twitter, username, count, **kwargs):
 	if len(retval["tweets"]):
 		retval["min_id"] = retval["tweets"][len(tweets) - 1]["id"]
 
-	rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
-	logger.info("twitter_search_rate_limit_left=" + rate_limit)
-
 	return(retval)
 
 
@@ -207,6 +310,151 @@ def backfill_tweets_lookup_error(e):
 		raise(e)
 
 
+#
+# Fill in the reply info on one of our tweets from the original tweet it replied to.
+#
+def backfill_row(row, parent):
+
+	if parent.error:
+		row.reply_error = parent.error
+		return
+
+	row.reply_time_t = parent.time_t
+	row.reply_username = parent.username
+	row.reply_url = "https://twitter.com/%s/status/%s" % (
+		row.reply_username, row.reply_tweet_id)
+	row.reply_age = row.time_t - row.reply_time_t
+
+
+#
+# Save an original tweet (or the error we got fetching it) to our cache
+# and return the cache row.
+#
+# orig - The tweet from Twitter's API, or None if we got an error
+# error - The error from backfill_tweets_lookup_error()
+#
+def cache_parent(tweet_id, orig = None, error = None):
+
+	parent = ReplyParents(tweet_id = tweet_id, fetched_time_t = int(time.time()))
+
+	if orig:
+		parent.time_t = parse_twitter_time(orig["created_at"])
+		parent.username = orig["user"]["screen_name"]
+	else:
+		parent.error = error
+
+	retval = session.merge(parent)
+
+	return(retval)
+
+
+#
+# Filter a query on our cache down to entries that are still valid.
+# Errors expire after --negative-cache-ttl seconds, original tweets never do.
+#
+def filter_cache_valid(query):
+
+	if args.negative_cache_ttl is None:
+		return(query)
+
+	return(query.filter((ReplyParents.error == None)
+		| (ReplyParents.fetched_time_t >= time.time() - args.negative_cache_ttl)))
+
+
+#
+# Forget the errors in our cache which are older than --negative-cache-ttl,
+# and clear reply_error on the tweets which replied to those original tweets,
+# so that the backfill looks them up again.
+#
+# @return an integer with the number of tweets which will be tried again
+#
+def retry_expired_errors():
+
+	retval = 0
+	batch_size = 500
+
+	if args.negative_cache_ttl is None:
+		return(retval)
+
+	ids = [ row.tweet_id for row in session.query(ReplyParents.tweet_id).filter(
+		ReplyParents.error != None).filter(
+		ReplyParents.fetched_time_t < time.time() - args.negative_cache_ttl) ]
+
+	for start in range(0, len(ids), batch_size):
+		batch = ids[start:start + batch_size]
+		retval += filter_reply_error(session.query(Tweets)).filter(
+			Tweets.reply_tweet_id.in_(batch)).update(
+			{ Tweets.reply_error: None }, synchronize_session = False)
+		session.query(ReplyParents).filter(ReplyParents.tweet_id.in_(batch)).delete(
+			synchronize_session = False)
+
+	session.commit()
+	logger.info("expired_reply_errors={} tweets_to_retry={}".format(len(ids), retval))
+
+	return(retval)
+
+
+#
+# Return the cached original tweet for a tweet ID, or None if it isn't cached.
+#
+def get_cached_parent(tweet_id):
+	return(filter_cache_valid(session.query(ReplyParents)).filter(
+		ReplyParents.tweet_id == tweet_id).first())
+
+
+#
+# Write the rows we just backfilled, along with the rollups they fall in,
+# record that each of their accounts has changed, and then notify the bot.
+#
+# Returns how many seconds we spent writing to the database.
+#
+def write_backfilled(rows):
+
+	start = time.time()
+
+	update_rollups(session, [ (row.username, row.time_t) for row in rows ])
+
+	usernames = sorted(set([ row.username for row in rows ]))
+
+	for username in usernames:
+		state = session.query(FetchState).get(username)
+		if state:
+			state.touch()
+
+	session.commit()
+	retval = time.time() - start
+
+	notify(usernames)
+
+	return(retval)
+
+
+#
+# Backfill any tweets which replied to original tweets that are already in our cache.
+# This is done in a single transaction, without making any API calls.
+#
+# @return an integer with the number of tweet reply-to info rows backfilled
+#
+def backfill_tweets_cache():
+
+	retval = 0
+
+	rows = filter_cache_valid(filter_backfill(session.query(Tweets, ReplyParents)).join(
+		ReplyParents, ReplyParents.tweet_id == Tweets.reply_tweet_id))
+
+	backfilled = []
+	for (row, parent) in rows:
+		backfill_row(row, parent)
+		session.add(row)
+		backfilled.append(row)
+		retval += 1
+
+	db_time = write_backfilled(backfilled)
+	logger.info("tweets_backfilled_from_cache={} db_time={:.3f}".format(retval, db_time))
+
+	return(retval)
+
+
 #
 # Select our tweets that need backfilling and then do so
 #
@@ -217,6 +465,7 @@ def backfill_tweets_lookup_error(e):
 def backfill_tweets(twitter):
 
 	retval = 0
+	db_time = 0
 	#
 	# Get tweets that:
 	# - Have a reply_tweet_id (were replies to tweets with that ID)
@@ -229,29 +478,43 @@ def backfill_tweets(twitter):
 	# For testing, you can get tweets to backfill with this query:
 	# UPDATE tweets SET reply_error=null, reply_time_t=null WHERE id IN ( SELECT id FROM tweets WHERE reply_error != '' LIMIT 3);
 	#
-	rows = session.query(Tweets).filter(Tweets.reply_tweet_id != None).filter(
-		Tweets.reply_error == None).filter(Tweets.reply_time_t == None)
+	retval += backfill_tweets_cache()
 
-	logger.info("tweets_to_backfill={}".format(rows.count()))
+	rows = filter_backfill(session.query(Tweets)).all()
+
+	logger.info("tweets_to_backfill={}".format(len(rows)))
 
 	for row in rows:
 
+		#
+		# An earlier row may have replied to the same original tweet.
+		#
+		parent = get_cached_parent(row.reply_tweet_id)
+		if parent:
+			backfill_row(row, parent)
+			session.add(row)
+			db_time += write_backfilled([row])
+			retval += 1
+			continue
+
 		try: 
 			logger.info("Backfilling tweet id=%d" % (row.tweet_id))
-			orig = twitter.show_status(id = row.reply_tweet_id)
+			orig = limiter.call(twitter, "show_status", twitter.show_status,
+				id = row.reply_tweet_id)
 
 			rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
 			logger.info("twitter_rate_limit_show_status_left=" + rate_limit)
 
-			row.reply_time_t = int(dateutil.parser.parse(orig["created_at"]).timestamp())
-			row.reply_username = orig["user"]["screen_name"]
-			row.reply_url = url = "https://twitter.com/%s/status/%s" % (
-				row.reply_username, row.reply_tweet_id)
-			row.reply_age = row.time_t - row.reply_time_t
+			backfill_row(row, cache_parent(row.reply_tweet_id, orig = orig))
+			if archive:
+				archive.write_parents([ orig ])
 
 		except twython.exceptions.TwythonError as e:
 			logger.info("Caught this exception: %s" % e)
-			row.reply_error = backfill_tweets_lookup_error(e)
+			error = backfill_tweets_lookup_error(e)
+			backfill_row(row, cache_parent(row.reply_tweet_id, error = error))
+			if archive:
+				archive.write_parents([], { row.reply_tweet_id: error })
 
 			rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
 			logger.info("twitter_rate_limit_show_status_left=" + rate_limit)
@@ -265,10 +528,114 @@ def backfill_tweets(twitter):
 			#
 
 		session.add(row)
-		session.commit()
+		db_time += write_backfilled([row])
 
 		retval += 1
 
+	logger.info("Backfilled {} tweets! db_time={:.3f}".format(len(rows), db_time))
+
+	return(retval)
+
+
+#
+# Select our tweets that need backfilling and backfill them in batches,
+# looking up to 100 original tweets with a single call to statuses/lookup.
+#
+# Each batch is written in a single transaction.
+#
+# @param object twitter Our Twitter object
+#
+# @return an integer with the number of tweet reply-to info rows backfilled
+#
+def backfill_tweets_lookup(twitter):
+
+	retval = 0
+	batch_size = 100
+	num_rows = 0
+	db_time = 0
+
+	retval += backfill_tweets_cache()
+
+	logger.info("tweets_to_backfill={}".format(
+		filter_backfill(session.query(Tweets)).count()))
+
+	while True:
+
+		#
+		# Several of our tweets can be replies to the same original tweet,
+		# so grab distinct IDs and then every row which replied to them.
+		#
+		ids = [ row.reply_tweet_id for row in filter_backfill(
+			session.query(Tweets.reply_tweet_id)).distinct().limit(batch_size) ]
+
+		if not len(ids):
+			break
+
+		rows = filter_backfill(session.query(Tweets)).filter(
+			Tweets.reply_tweet_id.in_(ids)).all()
+
+		logger.info("Backfilling {} tweets with {} original tweet IDs".format(
+			len(rows), len(ids)))
+		origs = limiter.call(twitter, "lookup_status", twitter.lookup_status,
+			id = ",".join([ str(id) for id in ids ]),
+			include_entities = False, trim_user = False)
+
+		rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
+		logger.info("twitter_rate_limit_lookup_status_left=" + rate_limit)
+
+		origs = { orig["id"]: orig for orig in origs }
+
+		parents = {}
+		errors = {}
+		for id in ids:
+
+			if id in origs:
+				parents[id] = cache_parent(id, orig = origs[id])
+
+			else:
+				#
+				# statuses/lookup silently leaves out tweets that it can't return,
+				# so treat those the same way as show_status() not finding them.
+				#
+				e = twython.exceptions.TwythonError(
+					"No status found with that ID: {}".format(id), error_code = 404)
+				logger.info("Caught this exception: %s" % e)
+				errors[id] = backfill_tweets_lookup_error(e)
+				parents[id] = cache_parent(id, error = errors[id])
+
+		if archive:
+			archive.write_parents(list(origs.values()), errors)
+
+		for row in rows:
+			backfill_row(row, parents[row.reply_tweet_id])
+			session.add(row)
+			retval += 1
+			num_rows += 1
+
+		db_time += write_backfilled(rows)
+
+	logger.info("Backfilled {} tweets! db_time={:.3f}".format(num_rows, db_time))
+
+	return(retval)
+
+
+#
+# Create a Twitter object with our credentials loaded into it.
+#
+# Twython objects hang onto the headers of their last call, so each
+# thread needs its own.
+#
+def get_twitter(config):
+
+	retval = twython.Twython(config.get("twitter_app_key"), config.get("twitter_app_secret"),
+		config.get("twitter_final_oauth_token"), config.get("twitter_final_oauth_token_secret"))
+
+	#
+	# Used for pointing us at a fake API such as bench/fake_twitter.py
+	#
+	if config.get("twitter_api_url"):
+		retval.api_url = config.get("twitter_api_url") + "/%s"
+
 	return(retval)
 
 
@@ -279,10 +646,9 @@ def backfill_tweets(twitter):
 #
 def verify_twitter_credentials(config):
 
-	twitter = twython.Twython(config.get("twitter_app_key"), config.get("twitter_app_secret"),
-		config.get("twitter_final_oauth_token"), config.get("twitter_final_oauth_token_secret"))
+	twitter = get_twitter(config)
 
-	creds = twitter.verify_credentials()
+	creds = limiter.call(twitter, "verify_credentials", twitter.verify_credentials)
 	rate_limit = twitter.get_lastfunction_header('x-rate-limit-remaining')
 	logger.info("twitter_rate_limit_verify_credentials_left=" + rate_limit)
 
@@ -293,31 +659,22 @@ def verify_twitter_credentials(config):
 
 
 #
-# Return the maximum Tweet ID or None if there are no tweets.
-#
-def get_max_tweet_id(session, username):
-
-	retval = None
-	row = session.query(func.max(Tweets.tweet_id).label("max")).filter(
-		Tweets.username == username).first()
-
-	if row:
-		retval = row.max
-
-	return(retval)
-
-
+# Return the FetchState row for a user, creating it if we don't have one yet.
 #
-# Return the minimum Tweet ID or None if there are no tweets.
+# Databases from before we kept track of this get their cursors from
+# the tweets table, which is the only time we need to look there.
 #
-def get_min_tweet_id(session, username):
+def get_fetch_state(username):
 
-	retval = None
-	row = session.query(func.min(Tweets.tweet_id).label("min")).filter(
-		Tweets.username == username).first()
+	retval = session.query(FetchState).get(username)
 
-	if row:
-		retval = row.min
+	if not retval:
+		retval = FetchState(username = username,
+			min_tweet_id = get_min_tweet_id(session, username),
+			max_tweet_id = get_max_tweet_id(session, username),
+			history_complete = False, updated_time_t = int(time.time()))
+		session.add(retval)
+		session.commit()
 
 	return(retval)
 
@@ -325,187 +682,421 @@ def get_min_tweet_id(session, username):
 #
 # Prime our Tweets table by fetching the first one.
 #
-def getTweetsPrime(config, twitter, tweets_left):
+def getTweetsPrime(username, twitter, tweets_left, state):
 
 	logger.info("No Max ID, which means no tweets, fetch one to prime our table.")
-	tweets = getTweets(twitter, config.get("twitter_username"), 1)
+	tweets = getTweets(twitter, username, 1)
 
 	if len(tweets["tweets"]) == 0:
 		logger.warning("No tweets found, completely bailing out!")
 		return(None)
-		
-	write_tweets(tweets["tweets"])
 
 	min_id = tweets["tweets"][0]["id"]
 	max_id = tweets["tweets"][0]["id"]
 	logger.info("min_tweet_id={} max_tweet_id={}".format(min_id, max_id))
 
+	state.min_tweet_id = min_id
+	state.max_tweet_id = max_id
+	write_tweets(tweets["tweets"], state)
+
 	tweets_left -= 1
 
-	return(tweets_left, len(tweets["tweets"]), min_id, max_id)
+	return(tweets_left, len(tweets["tweets"]))
 
 
 #
-# Fetch tweets that are before the lowest Tweet ID we currently have available.
+# Put an item onto our queue of pages, waiting if the queue is full.
 #
-def getTweetsPast(config, twitter, tweets_left, min_id):
+# Returns False if the consumer has stopped, in which case the item was not queued.
+#
+def putPage(pages, stop, item):
+
+	while not stop.is_set():
+		try:
+			pages.put(item, timeout = 1)
+			return(True)
+
+		except queue.Full:
+			continue
+
+	return(False)
 
-	num_tweets_fetched = 0
+
+#
+# The producer half of our pipeline. This runs in its own thread and
+# pages through a user's timeline, putting each raw page onto the queue
+# so that the next API call is made while the last page is still being written.
+#
+# Each item on the queue is a tuple of ("page", tweets), ("error", exception),
+# or ("done", (tweets_left, at_end)) when we are finished.
+#
+# Going into the past, we page backwards from cursor until Twitter has nothing older.
+# Going into the future, we page backwards from the newest tweet (or from max_id,
+# when picking up where an earlier run left off) down to cursor, so that there's
+# no gap if more than a page of tweets came in since our last run.
+#
+# @param string direction - "past" to fetch tweets before cursor, "future" for after it
+#
+# at_end is True if we got to the end rather than running out of tweets_left.
+#
+def fetchPages(username, twitter, tweets_left, cursor, max_id, direction, pages, stop):
 
 	num_passes_zero_tweets = 3
 	num_passes_zero_tweets_left = num_passes_zero_tweets
 
-	while True:
+	at_end = False
 
-		tweets_to_fetch = 200
-		#tweets_to_fetch = 1 # Debugging
-		if tweets_left < tweets_to_fetch:
-			tweets_to_fetch = tweets_left
+	try:
 
-		tweets = getTweets(twitter, config.get("twitter_username"), 
-			tweets_to_fetch, max_id = min_id)
-		tweets_left -= len(tweets["tweets"])
-		write_tweets(tweets["tweets"])
-		num_tweets_fetched += len(tweets["tweets"])
+		while True:
 
-		logger.info("tweets_fetched={}, tweets_left={}".format(len(tweets["tweets"]), tweets_left))
-		if tweets_left <= 0:
-			logger.info("Tweets left is {}, done fetching past tweets!".format(tweets_left))
-			break
+			tweets_to_fetch = 200
+			#tweets_to_fetch = 1 # Debugging
+			if tweets_left < tweets_to_fetch:
+				tweets_to_fetch = tweets_left
 
-		if len(tweets["tweets"]) == 0:
+			if direction == "past":
+				tweets = fetchTweets(twitter, username, tweets_to_fetch, max_id = cursor)
+			else:
+				tweets = fetchTweets(twitter, username, tweets_to_fetch,
+					min_id = cursor, max_id = max_id)
 
-			num_passes_zero_tweets_left -= 1
-			logger.info("We got zero tweets this pass! passes_left={}".format(
-				num_passes_zero_tweets_left))
+			tweets_left -= len(tweets)
+			if len(tweets) and not putPage(pages, stop, ("page", tweets)):
+				return
 
-			if num_passes_zero_tweets_left <= 0:
-				logger.info("Number of zero passes left == 0. Yep, we're at the end.")
+			logger.info("tweets_fetched={}, tweets_left={}".format(len(tweets), tweets_left))
+			if tweets_left <= 0:
+				logger.info("Tweets left is {}, done fetching {} tweets!".format(
+					tweets_left, direction))
 				break
 
-			continue
+			if len(tweets) == 0:
 
-		#
-		# We got some tweets, reset our zero tweets counter
-		#
-		num_passes_zero_tweets_left = num_passes_zero_tweets
+				num_passes_zero_tweets_left -= 1
+				logger.info("We got zero tweets this pass! passes_left={}".format(
+					num_passes_zero_tweets_left))
 
-		#
-		# Get the ID of the last tweet as our new min_id
-		#	
-		min_id = tweets["tweets"][len(tweets["tweets"]) - 1]["id"]
-		logger.info("New min_id is {}".format(min_id))
+				if num_passes_zero_tweets_left <= 0:
+					logger.info("Number of zero passes left == 0. Yep, we're at the end.")
+					at_end = True
+					break
 
-	return(tweets_left, num_tweets_fetched, min_id)
+				continue
+
+			#
+			# We got some tweets, reset our zero tweets counter
+			#
+			num_passes_zero_tweets_left = num_passes_zero_tweets
+
+			#
+			# Going back in time, the ID of the last tweet is our new min_id.
+			# Going forward, we keep paging down towards our old max_id.
+			#
+			if direction == "past":
+				cursor = tweets[len(tweets) - 1]["id"]
+				logger.info("New min_id is {}".format(cursor))
+			else:
+				max_id = tweets[len(tweets) - 1]["id"]
+				logger.info("Paging down from max_id {} to {}".format(max_id, cursor))
+
+	except Exception as e:
+		putPage(pages, stop, ("error", e))
+		return
+
+	putPage(pages, stop, ("done", (tweets_left, at_end)))
 
 
 #
-# Fetch tweets made after the latest one in our table.
+# Page through a user's timeline, parsing and writing each page as it comes in.
 #
-def getTweetsFuture(config, twitter, tweets_left, max_id):
+# Fetching happens in fetchPages() in a separate thread, so network and
+# database time overlap. The queue between them is bounded so that we never
+# hold more than a couple of pages in memory.
+#
+# Our FetchState is committed along with each page, so a crash (or running
+# out of --num) partway through doesn't lose our place:
+# - Going into the past, min_tweet_id moves down with every page.
+# - Going into the future, max_tweet_id only moves once we have paged all the
+#	way down to it, since a crash before then would otherwise leave a gap.
+#	Until then, the catchup_* columns record how far down we have got,
+#	and the next run carries on from there.
+#
+# @return A tuple of tweets left and the number of tweets fetched.
+#
+def getTweetsPipeline(username, twitter, tweets_left, state, direction):
 
 	num_tweets_fetched = 0
+	max_id = None
 
-	num_passes_zero_tweets = 3
-	num_passes_zero_tweets_left = num_passes_zero_tweets
+	if direction == "past":
+		cursor = state.min_tweet_id
 
-	while True:
+	elif state.catchup_max_id is not None:
+		cursor = state.catchup_since_id
+		max_id = state.catchup_max_id
+		logger.info("Carrying on catching up with {}'s timeline from max_id {} down to {}".format(
+			username, max_id, cursor))
 
-		tweets_to_fetch = 200
-		#tweets_to_fetch = 1 # Debugging
-		if tweets_left < tweets_to_fetch:
-			tweets_to_fetch = tweets_left
+	else:
+		cursor = state.max_tweet_id
 
-		tweets = getTweets(twitter, config.get("twitter_username"), tweets_to_fetch, min_id = max_id)
-		tweets_left -= len(tweets["tweets"])
-		write_tweets(tweets["tweets"])
-		num_tweets_fetched += len(tweets["tweets"])
+	pages = queue.Queue(maxsize = 2)
+	stop = threading.Event()
 
-		logger.info("tweets_fetched={}, tweets_left={}".format(len(tweets["tweets"]), tweets_left))
-		if tweets_left <= 0:
-			logger.info("Tweets left is {}, done fetching past tweets!".format(tweets_left))
-			break
+	producer = threading.Thread(target = fetchPages, daemon = True,
+		args = (username, twitter, tweets_left, cursor, max_id, direction, pages, stop))
+	producer.start()
+
+	try:
 
-		if len(tweets["tweets"]) == 0:
+		while True:
 
-			num_passes_zero_tweets_left -= 1
-			logger.info("We got zero tweets this pass! passes_left={}".format(
-				num_passes_zero_tweets_left))
+			(kind, value) = pages.get()
 
-			if num_passes_zero_tweets_left <= 0:
-				logger.info("Number of zero passes left == 0. Yep, we're at the end.")
-				break
+			if kind == "error":
+				raise(value)
 
-			continue
+			elif kind == "done":
+				(tweets_left, at_end) = value
+				break
 
+			tweets = parseTweets(value)
+			if direction == "past":
+				state.min_tweet_id = min(state.min_tweet_id, tweets[len(tweets) - 1]["id"])
+			else:
+				state.catchup_since_id = cursor
+				state.catchup_max_id = min(state.catchup_max_id or value[len(value) - 1]["id"],
+					value[len(value) - 1]["id"])
+				state.catchup_newest_id = max(state.catchup_newest_id or 0, value[0]["id"])
+			write_tweets(tweets, state)
+			num_tweets_fetched += len(tweets)
+
+	finally:
 		#
-		# We got some tweets, reset our zero tweets counter
+		# If we bailed out, make sure the producer doesn't wait on us forever.
 		#
-		num_passes_zero_tweets_left = num_passes_zero_tweets
+		stop.set()
 
-		#
-		# Get the ID of the first tweet as our new max_id
-		#	
-		max_id = tweets["tweets"][0]["id"]
-		logger.info("New max_id is {}".format(max_id))
+	producer.join()
+
+	if direction == "past" and at_end:
+		logger.info("We've reached the start of {}'s timeline".format(username))
+		state.history_complete = True
+
+	elif direction == "future":
+		if at_end:
+			if state.catchup_newest_id is not None:
+				state.max_tweet_id = max(state.max_tweet_id, state.catchup_newest_id)
+			state.catchup_since_id = None
+			state.catchup_max_id = None
+			state.catchup_newest_id = None
+		else:
+			logger.warning("Ran out of tweets to fetch before catching up with {}'s "
+				"timeline, we'll carry on from max_id {} next time".format(
+				username, state.catchup_max_id))
+
+	state.updated_time_t = int(time.time())
+	session.commit()
 
 	return(tweets_left, num_tweets_fetched)
 
 
 #
-# Our main function.
+# Fetch tweets that are before the lowest Tweet ID we currently have available.
 #
-def main(args):
+def getTweetsPast(username, twitter, tweets_left, state):
+	return(getTweetsPipeline(username, twitter, tweets_left, state, "past"))
 
-	ini_file = os.path.dirname(os.path.realpath(__file__)) + "/../config.ini"
-	logger.info("Ini file path: {}".format(ini_file))
-	config = configParser.Config(ini_file)
 
-	twitter = verify_twitter_credentials(config)
+#
+# Fetch tweets made after the latest one in our table.
+#
+def getTweetsFuture(username, twitter, tweets_left, state):
+
+	resumed = state.catchup_max_id is not None
+
+	(tweets_left, num_tweets_fetched) = getTweetsPipeline(
+		username, twitter, tweets_left, state, "future")
+
+	#
+	# If we carried on from an earlier run, we only went up as far as the newest
+	# tweet back then, so go around again for anything newer than that.
+	#
+	if resumed and state.catchup_max_id is None and tweets_left > 0:
+		(tweets_left, num_more_fetched) = getTweetsPipeline(
+			username, twitter, tweets_left, state, "future")
+		num_tweets_fetched += num_more_fetched
+
+	return(tweets_left, num_tweets_fetched)
 
-	max_id = get_max_tweet_id(session, config.get("twitter_username"))
-	min_id = get_min_tweet_id(session, config.get("twitter_username"))
-	logger.info("min_tweet_id={} max_tweet_id={}".format(min_id, max_id))
+
+#
+# Fetch tweets for a single account.
+# This is run in a thread, once for each account.
+#
+# Returns True if we stopped early with older tweets still left to fetch,
+# or before we had caught up with newer ones.
+#
+def fetch_account(config, username, args):
+
+	logger.info("Fetching tweets for username: {}".format(username))
+
+	twitter = get_twitter(config)
+
+	state = get_fetch_state(username)
+	logger.info("username={} min_tweet_id={} max_tweet_id={} history_complete={} catchup_max_id={}".format(
+		username, state.min_tweet_id, state.max_tweet_id, state.history_complete, state.catchup_max_id))
 
 	tweets_left = args.num
 	num_tweets_fetched_total = 0
 
-	if not max_id:
+	if not state.max_tweet_id:
 		#
 		# We have no tweets, so fetch one.
 		#
-		(tweets_left, num_tweets_fetched, min_id, max_id) = getTweetsPrime(
-			config, twitter, tweets_left)
+		result = getTweetsPrime(username, twitter, tweets_left, state)
+		if not result:
+			return(False)
+
+		(tweets_left, num_tweets_fetched) = result
 		num_tweets_fetched_total += num_tweets_fetched
 
 
 	#
-	# Now fetch tweets before our min Tweet ID.
+	# Now fetch tweets before our min Tweet ID, unless we already have them all.
 	#
-	(tweets_left, num_tweets_fetched, min_id) = getTweetsPast(
-		config, twitter, tweets_left, min_id)
-	num_tweets_fetched_total += num_tweets_fetched
+	if not state.history_complete:
+		(tweets_left, num_tweets_fetched) = getTweetsPast(
+			username, twitter, tweets_left, state)
+		num_tweets_fetched_total += num_tweets_fetched
 
-	if tweets_left <= 0:
-		logger.info("We're done fetching tweets ({} tweets left)".format(tweets_left))
-		return(None)
+	else:
+		logger.info("We already have all of {}'s older tweets, skipping them.".format(username))
 
-	max_id = get_max_tweet_id(session, config.get("twitter_username"))
+	if tweets_left <= 0:
+		logger.info("We're done fetching tweets for {} ({} tweets left)".format(
+			username, tweets_left))
+		return(True)
 
 
 	#
 	# Now fetch tweets after our max tweet ID in case some new ones came in.
 	#
 	(tweets_left, num_tweets_fetched) = getTweetsFuture(
-		config, twitter, tweets_left, max_id)
+		username, twitter, tweets_left, state)
 	num_tweets_fetched_total += num_tweets_fetched
 
-	logger.info("Total Number of tweets fetched: {}".format(num_tweets_fetched_total))
+	logger.info("username={} Total Number of tweets fetched: {}".format(
+		username, num_tweets_fetched_total))
+
+	return(state.catchup_max_id is not None)
+
+
+#
+# Wrapper for fetch_account() to be run in our thread pool, which
+# makes sure that the thread's database session is cleaned up afterwards.
+#
+def fetch_account_thread(config, username, args):
+
+	try:
+		return(fetch_account(config, username, args))
+
+	finally:
+		session.remove()
+
+
+#
+# Rebuild or extend our tables from the raw API responses in our archive.
+# Tweets we already have are skipped, and no API calls are made.
+#
+def reprocess(dir):
+
+	num_tweets = 0
+	num_parents = 0
+	usernames = set()
+	start = time.time()
+
+	for record in read_archive(dir):
+
+		if record["kind"] == "timeline":
+			tweets = parseTweets(record["tweets"])
+			write_tweets(tweets)
+			num_tweets += len(tweets)
+			usernames.add(record["username"])
+
+		elif record["kind"] == "parents":
+			for orig in record["tweets"]:
+				cache_parent(orig["id"], orig = orig)
+			for id, error in record["errors"].items():
+				cache_parent(int(id), error = error)
+			session.commit()
+			num_parents += len(record["tweets"]) + len(record["errors"])
+
+	#
+	# Our cursors may be behind what's in the archive now, so bring them up to date.
+	#
+	for username in usernames:
+		state = get_fetch_state(username)
+		state.min_tweet_id = get_min_tweet_id(session, username)
+		state.max_tweet_id = get_max_tweet_id(session, username)
+		state.touch()
+	session.commit()
+	notify(usernames)
+
+	num_backfilled = backfill_tweets_cache()
+	checkpoint(session)
+
+	elapsed = time.time() - start
+	logger.info("reprocessed_tweets={} reprocessed_parents={} backfilled={} elapsed={:.2f} tweets_per_sec={:.0f}".format(
+		num_tweets, num_parents, num_backfilled, elapsed, num_tweets / max(elapsed, 0.001)))
+
+
+#
+# Our main function.
+#
+# Returns True if we stopped early with tweets still left to fetch.
+#
+def main(args):
+
+	ini_file = args.config
+	logger.info("Ini file path: {}".format(ini_file))
+	config = configParser.Config(ini_file)
+
+	#
+	# We only need to verify our credentials once, not on every loop.
+	#
+	global twitter
+	if not twitter:
+		twitter = verify_twitter_credentials(config)
+
+	usernames = config.get_list("twitter_username")
+	logger.info("Fetching tweets for {} accounts: {}".format(len(usernames), usernames))
+
+	#
+	# Fetch all of our accounts at once. Since they all share one rate limiter,
+	# this is limited by our API quota rather than the number of accounts.
+	#
+	backlog = False
+	with concurrent.futures.ThreadPoolExecutor(max_workers = args.threads) as executor:
+
+		futures = [ executor.submit(fetch_account_thread, config, username, args)
+			for username in usernames ]
+
+		for future in futures:
+			if future.result():
+				backlog = True
 
 	logger.info("Now backfilling reply info on any tweets that are replies.")
-	num_tweets_backfilled = backfill_tweets(twitter)
+	retry_expired_errors()
+	if args.backfill_mode == "lookup":
+		num_tweets_backfilled = backfill_tweets_lookup(twitter)
+	else:
+		num_tweets_backfilled = backfill_tweets(twitter)
 	logger.info("total_tweets_backfilled=%d" % num_tweets_backfilled)
 
+	checkpoint(session)
+
 	logger.info("ok=1")
 
 	#
@@ -514,11 +1105,16 @@ def main(args):
 	#
 	sys.stdout.flush()
 
+	return(backlog)
+
 # End of main()
 
 
 
-if not args.loop:
+if args.reprocess:
+	reprocess(args.archive)
+
+elif not args.loop:
 	try:
 		main(args)
 	except Exception as e:
@@ -527,14 +1123,31 @@ if not args.loop:
 
 else:
 	while True:
+
+		backlog = False
+
 		try:
-			main(args)
+			backlog = main(args)
 		except Exception as e:
 			traceback.print_exc()
 
+		#
+		# Give our session back before we sleep, so we aren't left sitting in a
+		# transaction (and holding its locks, in databases such as Postgres) until we wake up.
+		#
+		session.remove()
+
+		#
+		# If we still have tweets to fetch, there's no point in waiting around
+		# for --loop seconds. Go again as soon as the rate limit lets us.
+		#
+		sleep_secs = args.loop
+		if backlog:
+			sleep_secs = limiter.get_wait("user_timeline")
+			logger.info("We still have tweets to fetch!")
 
-		logger.info("Sleeping for %d seconds..." % args.loop)
-		time.sleep(args.loop)
+		logger.info("Sleeping for %d seconds..." % sleep_secs)
+		time.sleep(sleep_secs)
 		logger.info("Waking up!")
 
 
@@ -28,6 +28,19 @@ then
 fi
 
 
+#
+# We can only back up a SQLite database. Other databases have their own tools for this.
+#
+DATABASE_URL=${TWEETS_DATABASE_URL:-$(cat /mnt/config.ini | grep database_url | cut -d= -f2- | awk '{print $1}')}
+if test "$DATABASE_URL" -a "${DATABASE_URL#sqlite}" == "$DATABASE_URL"
+then
+	echo "! "
+	echo "! Our database isn't SQLite, so there's nothing for us to back up."
+	echo "! Please use your database's own backup tools instead."
+	echo "! "
+	exit 1
+fi
+
 export S3=$(cat /mnt/config.ini | grep aws_s3_bucket | cut -d= -f2 | awk '{ print $1 }')
 export AWS_ACCESS_KEY_ID=$(cat /mnt/config.ini | grep aws_access_key_id | cut -d= -f2 | awk '{print $1}')
 export AWS_SECRET_ACCESS_KEY=$(cat /mnt/config.ini | grep aws_secret_access_key | cut -d= -f2 | awk '{print $1}')
@@ -65,8 +78,21 @@ do
 
 	TMP=$(mktemp /tmp/backup-XXXXXXX)
 
+	#
+	# Our database is in WAL mode, so recent writes may only be in tweets.db-wal,
+	# and copying tweets.db with cp could miss them or catch a write halfway through.
+	# SQLite's backup API gives us a consistent copy without stopping the fetcher.
+	#
 	echo "# Making a copy of the database..."
-	cp /mnt/tweets.db $TMP
+	python3 - /mnt/tweets.db $TMP << EOF
+import sqlite3, sys
+source = sqlite3.connect(sys.argv[1], timeout = 30)
+target = sqlite3.connect(sys.argv[2])
+source.backup(target)
+target.execute("PRAGMA journal_mode = DELETE")
+target.close()
+source.close()
+EOF
 
 	echo "# Now backing up database to '$TARGET' on S3..."
 	aws s3 cp $TMP $TARGET
@@ -8,20 +8,26 @@ import datetime, time
 import json
 import logging as logger
 import logging.config
-import math
 import os
 import sys
 import time
 
-import dateparser
 import schedule
-from sqlalchemy.sql.expression import func
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 
 sys.path.append("lib")
-from tables import create_all, get_session, Tweets
+from columnar import ColumnarCache
+from delivery import Delivery
+from notify import Listener
+from queries import get_last_tweet
+from reportcache import ReportCache
+from rollups import get_rollup_stats_windows, migrate_rollups
+from since import parse_since
+from tables import create_all, get_database_url, get_session, Tweets
 import config as configParser
-import telegram
+
+#
+# python-telegram-bot is only needed to answer commands, so it's imported when we get to those.
+#
 
 
 #
@@ -30,10 +36,14 @@ import telegram
 parser = argparse.ArgumentParser(description = "Get statistics for recent tweets and replies from an account.")
 parser.add_argument("--debug", action = "store_true", help = "Debugging output")
 parser.add_argument("--fake", action = "store_true", help = "Fake mode, don't send actual message to Telegram")
-parser.add_argument("--since", type = str, help = "How far back to go in time for each query? Can be a string such as \"one hour ago\", etc. Default: 1 day ago", default = "1 day ago")
+parser.add_argument("--since", type = str, nargs = "+", help = "How far back to go in time for each query? Can be a string such as \"one hour ago\", or short for one, such as \"6h\" or \"7d\". Several can be given, such as --since \"6 hours ago\" \"3 days ago\", and each report will cover all of them. Default: 1 day ago", default = [ "1 day ago" ])
+parser.add_argument("--no-memory-cache", action = "store_true", help = "Don't keep a copy of our tweets in memory, read every report from the database instead. Saves about 21 bytes per tweet.")
+parser.add_argument("--no-commands", action = "store_true", help = "Don't answer commands such as /stats sent to the bot, only send scheduled reports")
 parser.add_argument("--interval", type = int, 
-	help = "How many seconds to pause between reports? If set to 60 seconds or less, polling will be once/sec. Otherwise polling will be once/min. (Default: 3600)", 
+	help = "How many seconds to pause between reports? (Default: 3600)", 
 	default = 3600)
+parser.add_argument("--on-new-data", action = "store_true", help = "Also send a report for an account as soon as 1-fetch-tweets writes or backfills tweets for it, instead of waiting for the next scheduled report")
+parser.add_argument("--new-data-delay", type = int, help = "With --on-new-data, how many seconds to wait for more data after the first of it lands, so that a burst of pages and backfills is sent as one report. (Default: 10)", default = 10)
 args = parser.parse_args()
 
 #
@@ -46,6 +56,11 @@ else:
 
 logger.info("Args: {}".format(args))
 
+#
+# Parse our time windows once, so that each report only has to count back from the current time.
+#
+windows = [ parse_since(since) for since in args.since ]
+
 
 #
 # Load our config.ini file
@@ -55,138 +70,100 @@ logger.info("Ini file path: {}".format(ini_file))
 config = configParser.Config(ini_file)
 
 #
-# Set up our Telegram bot
+# Our Telegram settings.
+# Reports go to every chat in telegram_chat_id, and telegram_api_url can point us
+# at something other than Telegram, such as bench/fake_telegram.py.
+#
+# We don't test our access to Telegram up front. If our token is bad,
+# every message will fail with an error in our logs instead.
 #
-logger.info("Setting up our Telegram bot...")
 token = config.get("telegram_bot_token")
-chat_id = config.get("telegram_chat_id")
-bot = telegram.Bot(token)
-
-try:
-	logger.info("Testing access to Telegram...")
-	update_id = bot.get_updates()[0].update_id
-except IndexError:
-	pass
-
-logger.info("We can access Telegram!")
+chat_ids = config.get_list("telegram_chat_id")
+api_url = config.get("telegram_api_url")
 
 
 #
-# Connect to the database
+# Connect to the database.
+# Commands are answered in the Telegram dispatcher's threads, so each thread gets its own session.
 #
-session = get_session()
-
+session = get_session(scoped = True, url = get_database_url(config))
+migrate_rollups(session)
 
 #
-# Parse our timestamp and return the time_t.
-# This is meant to be called once for each loop so that we get 
-# a new value each time.
+# Reports are only rebuilt when an account's data has changed.
 #
-def parse_time(since):
-
-	logger.info("Parsing our timestamp...")
-	now = datetime.datetime.now()
-	now_time_t = time.mktime(now.timetuple())
-
-	#
-	# All times should be in GMT, so we're going to force that here
-	#
-	start = dateparser.parse(since + " GMT")
-
-	if not start:
-		raise Exception("Unable to parse our time string: {}".format(args.since))
-	logger.info("Timestamp parsed as: {}".format(start))
-
-	retval = time.mktime(start.timetuple())
+cache = ReportCache()
 
-	return(retval)
+#
+# Our reports are sent in the background, so a slow or failing call to Telegram
+# doesn't hold up the next report.
+#
+delivery = Delivery(token, api_url = api_url)
 
 
 #
-# Return the username that we're looking for tweets from
+# Return the usernames that we're looking for tweets from
 #
-def get_username(config):
-	user = config.get("twitter_username")
-	return(user)
+def get_usernames(config):
+	users = config.get_list("twitter_username")
+	return(users)
 
 
 #
-# Get stats for tweets that were replied to.
+# Get stats for tweets that were replied to, from the stats for our time window.
 #
-def getReplyStats(username, start_time_t):
+def getReplyStats(username, start_time_t, stats):
 
 	retval = {}
 
-	retval["min_reply_time_sec"] = session.query(
-		func.min(Tweets.reply_age).label("min")).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).filter(
-		Tweets.reply_tweet_id != None).filter(
-		Tweets.reply_age != 0).first().min
+	retval["min_reply_time_sec"] = stats["min_reply_age"]
 	retval["min_reply_time"] = round(retval["min_reply_time_sec"] / 60, 0)
 
-	retval["max_reply_time_sec"] = session.query(
-		func.max(Tweets.reply_age).label("max")).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).filter(
-		Tweets.reply_tweet_id != None).filter(
-		Tweets.reply_age != 0).first().max
+	retval["max_reply_time_sec"] = stats["max_reply_age"]
 	retval["max_reply_time"] = round(retval["max_reply_time_sec"] / 60, 0)
 
-	retval["avg_reply_time_sec"] = session.query(
-		func.avg(Tweets.reply_age).label("avg")).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).filter(
-		Tweets.reply_tweet_id != None).filter(
-		Tweets.reply_age != 0).first().avg
-	retval["avg_reply_time_sec"] = round(retval["avg_reply_time_sec"], 2)
+	retval["avg_reply_time_sec"] = round(stats["avg_reply_age"], 2)
 	retval["avg_reply_time"] = round(retval["avg_reply_time_sec"] / 60, 0)
 
-	median_stats = getReplyStatsMedian(start_time_t, retval)
-	retval = { **retval, **median_stats }
+	percentile_stats = getReplyStatsPercentiles(stats)
+	retval = { **retval, **percentile_stats }
 
 	return(retval)
 
 
 #
-# Get the median time for reply stats.
+# Get the median, 90th and 99th percentile reply times.
+#
+# These are exact if they come from our in-memory copy of our tweets,
+# and estimated to within 1% if they come from the sketches in our rollups.
 #
-def getReplyStatsMedian(start_time_t, retval):
+def getReplyStatsPercentiles(stats):
 
 	retval = {}
 
-	#
-	# Get our median reply time by getting all reply ages in sorted order
-	# and then 
-	#
-	rows = session.query(Tweets).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).filter(
-		Tweets.reply_tweet_id != None).filter(
-		Tweets.reply_age != 0).order_by(Tweets.reply_age)
-	times = []
-	for row in rows:
-		times.append(row.reply_age)
-	num_rows = len(times)
+	for name, percentile in [ ("median", 50), ("p90", 90), ("p99", 99) ]:
+		value = stats["sketch"].get_percentile(percentile)
+		if value is not None:
+			retval[name + "_reply_time_sec"] = value
+			retval[name + "_reply_time"] = round(value / 60, 0)
 
-	#
-	# If we have an odd number of rows, this is easy, just grab the middle row.
-	# If it's even, we have to grab the two center rows and then average them.
-	#
-	if num_rows:
-		if num_rows % 2:
-			index = math.ceil(num_rows / 2) - 1
-			retval["median_reply_time_sec"] = times[index]
+	return(retval)
 
-		else:
-			index1 = int(num_rows / 2 - 1)
-			index2 = int(num_rows / 2 )
-			val1 = times[index1]
-			val2 = times[index2]
-			avg = (val1 + val2) / 2
-			retval["median_reply_time_sec"] = avg
 
-		retval["median_reply_time"] = round(retval["median_reply_time_sec"] / 60, 0)
+#
+# Get the data for one of our time windows from its stats.
+#
+def get_window_data(username, start_time_t, stats):
+
+	retval = {}
+
+	retval["num_tweets"] = stats["num_tweets"]
+	retval["num_tweets_reply"] = stats["num_tweets_reply"]
+	retval["num_tweets_reply_timed"] = stats["num_tweets_reply_timed"]
+
+	if retval["num_tweets_reply_timed"]:
+		reply_stats = getReplyStats(username, start_time_t, stats)
+		retval = { **retval, **reply_stats }
 
 	return(retval)
 
@@ -195,74 +172,214 @@ def getReplyStatsMedian(start_time_t, retval):
 # Run queries against our database for tweet data
 #
 # username - The username to search for
-# start_time_t - The start of this time period
+# start_times - The start of each of our time periods
+#
+# The data for each time period is in the "windows" list, in the same order as start_times.
 #
-def get_tweet_data(username, start_time_t):
+def get_tweet_data(username, start_times):
 
 	retval = {}
 
 	retval["username"] = username 
 
-	retval["num_tweets"] = session.query(func.count(Tweets.tweet_id).label("cnt")).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).first().cnt
-
-	retval["num_tweets_reply"] = session.query(func.count(Tweets.tweet_id
-		).label("cnt")).filter(
-		Tweets.username == username).filter(
-		Tweets.time_t >= start_time_t).filter(
-		Tweets.reply_tweet_id != None).first().cnt
-
-	retval["last_tweet_date"] = session.query(Tweets).filter(
-		Tweets.username == username).order_by(
-		Tweets.tweet_id.desc()).first().date
+	#
+	# Our stats come from the copy of our tweets that we keep in memory,
+	# or if we're not keeping one, from our hourly rollups.
+	#
+	if columnar:
+		stats = columnar.get_stats(session, username, start_times)
+	else:
+		stats = get_rollup_stats_windows(session, username, start_times)
+	retval["windows"] = [ get_window_data(username, start_time_t, stats[start_time_t])
+		for start_time_t in start_times ]
 
-	if retval["num_tweets_reply"]:
-		reply_stats = getReplyStats(username, start_time_t)
-		retval = { **retval, **reply_stats }
+	retval["last_tweet_date"] = None
+	last_tweet = get_last_tweet(session, username)
+	if last_tweet:
+		retval["last_tweet_date"] = last_tweet.date
 
 	return(retval)
 
 
 #
-# Our main entry point.
+# Return the part of our report for a single time window.
 #
-def main():
+def format_window(since, data):
 
-	start_time_t = parse_time(args.since)
-	data = get_tweet_data(username, start_time_t)
-
-	message = ("Tweet activity for user: {username}\n"
-		+ "Since: {}\n"
+	retval = ("Since: {}\n"
 		+ "Num Tweets: {num_tweets}\n"
 		+ "Num Replies: {num_tweets_reply}\n"
-		).format(args.since, **data)
+		).format(since, **data)
 
-	if data["num_tweets_reply"]:
-		message += (
+	if data["num_tweets_reply_timed"]:
+		retval += (
 			"Min Reply time: {min_reply_time} min\n"
 			#+ "Max reply time: {max_reply_time} min\n"
 			+ "Avg reply time: {avg_reply_time} min\n"
-			+ "Median reply time: {median_reply_time} min"
-			).format(args.since, **data)
+			+ "Median reply time: {median_reply_time} min\n"
+			+ "P90 reply time: {p90_reply_time} min\n"
+			+ "P99 reply time: {p99_reply_time} min"
+			).format(since, **data)
 
 	else:
-		message += "(No reply data to include in this report)"
+		retval += "(No reply data to include in this report)"
+
+	return(retval)
+
 
-	message += "\nLast Tweet: {} UTC".format(data["last_tweet_date"])
+#
+# Return the report for a single username, covering a list of time windows.
+#
+def format_report(username, sinces, data):
+
+	retval = "Tweet activity for user: {}\n".format(username)
+
+	retval += "\n\n".join([ format_window(since, window)
+		for since, window in zip(sinces, data["windows"]) ])
+
+	retval += "\nLast Tweet: {} UTC".format(data["last_tweet_date"])
+
+	return(retval)
+
+
+#
+# Build and send the report for a single username, covering all of our time windows.
+#
+# Our session is given back afterwards, so we aren't left sitting in a transaction
+# until the next report, which could be hours away. That would hold locks in
+# databases such as Postgres, and keep our connection from being checked by the pool.
+#
+def send_report(username, start_times):
+
+	try:
+		data = cache.get(session, tuple(args.since), username, start_times, get_tweet_data)
+
+	finally:
+		session.remove()
+
+	message = format_report(username, args.since, data)
 
 	# Send reports to Telegram
 	logging.info("Sending message to Telegram: {}".format(message.replace("\n", "  ")))
 	if not args.fake:
-		bot.send_message(chat_id = chat_id, text = message)
+		num_queued = delivery.send(chat_ids, message)
+		logging.info("Message queued for {} of {} chats!".format(num_queued, len(chat_ids)))
 	else:
 		logging.info("--fake was specified so we really didn't send that message.")
-	logging.info("Message sent!")
 
 
-username = get_username(config)
-#username = "dmuth" # Debugging
-logger.info("Reporting on Twitter username: {}".format(username))
+#
+# Our main entry point.
+#
+def main():
+
+	start_times = [ window.get_start_time_t() for window in windows ]
+
+	for username in usernames:
+		send_report(username, start_times)
+
+	#
+	# Any accounts that were waiting to be reported on for new data just were.
+	#
+	changed.clear()
+
+
+#
+# Send reports for accounts that we were told have new data.
+#
+def report_new_data():
+
+	names = [ username for username in usernames if username in changed ]
+
+	if names:
+		logger.info("New data for {}, sending reports...".format(names))
+		start_times = [ window.get_start_time_t() for window in windows ]
+		for username in names:
+			send_report(username, start_times)
+
+	changed.clear()
+
+
+#
+# Split up the arguments to a /stats command into a list of usernames and a time window.
+#
+# Words starting with @ are usernames, and everything else is the time window,
+# so "/stats @dmuth 6 hours ago" (or "/stats @dmuth 6h") reports on dmuth since 6 hours ago.
+# Without any usernames we report on all of them, and without a time
+# window we use our --since windows.
+#
+def parse_stats_args(words):
+
+	names = [ word[1:] for word in words if word.startswith("@") ]
+	since = " ".join([ word for word in words if not word.startswith("@") ])
+
+	retval_usernames = usernames
+	if names:
+		lookup = { username.lower(): username for username in usernames }
+		unknown = [ name for name in names if name.lower() not in lookup ]
+		if unknown:
+			raise Exception("I'm not keeping track of: {}".format(
+				", ".join([ "@" + name for name in unknown ])))
+		retval_usernames = [ lookup[name.lower()] for name in names ]
+
+	retval_sinces = args.since
+	if since:
+		retval_sinces = [ since ]
+
+	return(retval_usernames, retval_sinces)
+
+
+#
+# Answer a /stats command.
+#
+# These don't go through our report cache, since they can ask for any window.
+#
+def stats_command(bot, update, args):
+
+	start = time.time()
+	logger.info("Got command: /stats {}".format(" ".join(args)))
+
+	try:
+		(names, sinces) = parse_stats_args(args)
+		start_times = [ parse_since(since).get_start_time_t() for since in sinces ]
+
+		for username in names:
+			data = get_tweet_data(username, start_times)
+			update.message.reply_text(format_report(username, sinces, data))
+
+	except Exception as e:
+		logger.warning("Unable to answer /stats {}: {}".format(" ".join(args), e))
+		update.message.reply_text("Sorry, I couldn't do that: {}".format(e))
+
+	finally:
+		session.remove()
+
+	logger.info("Answered /stats in {:.3f} seconds".format(time.time() - start))
+
+
+usernames = get_usernames(config)
+#usernames = ["dmuth"] # Debugging
+logger.info("Reporting on Twitter usernames: {}".format(usernames))
+
+#
+# Load our tweets into memory.
+#
+columnar = None
+if not args.no_memory_cache:
+	columnar = ColumnarCache()
+	columnar.refresh(session)
+	session.remove()
+
+#
+# Start listening for new data before our first report, so we don't miss any.
+# Accounts with new data are kept in changed until we report on them.
+#
+listener = None
+if args.on_new_data:
+	listener = Listener()
+
+changed = set()
+changed_time_t = 0
 
 #
 # Schedule main() to run during intervals
@@ -272,25 +389,73 @@ logger.info("Scheduled main() to run every {} seconds, starting first one now...
 main()
 
 
-while True:
+#
+# Answer commands in the background while we wait for our next report.
+# We only listen to the chats that our reports go to.
+# This is done after our first report, so that doesn't wait on loading python-telegram-bot.
+#
+# With no chats to listen to, an empty filter would let any chat ask for stats,
+# so we don't listen at all.
+#
+if not args.no_commands and not chat_ids:
+	logger.warning("No telegram_chat_id is set, so not listening for /stats commands.")
 
-	logger.info("Waking up in main loop!")
-	schedule.run_pending()
+elif not args.no_commands:
+
+	from telegram.ext import Updater, CommandHandler, Filters
+
+	base_url = None
+	if api_url:
+		base_url = api_url + "/bot"
+
+	updater = Updater(token = token, base_url = base_url)
 
 	#
-	# If we have an interval of less than a minute, we're probably developing,
-	# so sleep for only a second.  Otherwise, sleep for a full minute.
+	# Chats are given by their numeric IDs, but channels can also be given by their @username.
 	#
-	if args.interval <= 60:
-		sleep_secs = 1
-	else:
-		sleep_secs = 60
+	ids = [ int(chat_id) for chat_id in chat_ids if chat_id.lstrip("-").isdigit() ]
+	names = [ chat_id for chat_id in chat_ids if not chat_id.lstrip("-").isdigit() ]
+
+	command_filter = None
+	if ids:
+		command_filter = Filters.chat(chat_id = ids)
+	if names:
+		if command_filter:
+			command_filter = command_filter | Filters.chat(username = names)
+		else:
+			command_filter = Filters.chat(username = names)
+
+	updater.dispatcher.add_handler(CommandHandler("stats", stats_command,
+		filters = command_filter, pass_args = True))
+	updater.start_polling()
+	logger.info("Listening for /stats commands...")
+
 
-	logger.info(
-		"Going to sleep for {} seconds, interval is {} seconds.".format(
+#
+# Sleep until our next report is due, or until we're told about new data.
+#
+while True:
+
+	sleep_secs = schedule.idle_seconds()
+	if changed:
+		sleep_secs = min(sleep_secs, changed_time_t + args.new_data_delay - time.time())
+	sleep_secs = max(sleep_secs, 0)
+
+	logger.debug("Going to sleep for {:.1f} seconds, interval is {} seconds.".format(
 		sleep_secs, args.interval))
-	time.sleep(sleep_secs)
 
+	if listener:
+		new_data = listener.wait(sleep_secs)
+		if new_data:
+			logger.debug("Told about new data for: {}".format(new_data))
+			if not changed:
+				changed_time_t = time.time()
+			changed.update(new_data)
+	else:
+		time.sleep(sleep_secs)
 
+	if changed and time.time() >= changed_time_t + args.new_data_delay:
+		report_new_data()
 
+	schedule.run_pending()
 
@@ -0,0 +1,199 @@
+#
+# Archive of raw responses from Twitter's API.
+#
+# We only keep a handful of fields from each tweet in the database, so the raw
+# pages are written here as JSON lines in compressed segment files. New metrics
+# can then be computed by reprocessing the archive instead of re-crawling.
+#
+# Segments are compressed with zstd if the zstandard module is installed,
+# otherwise with gzip. Reading zstd segments back needs zstandard too.
+#
+
+import glob
+import gzip
+import io
+import json
+import logging as logger
+import os
+import threading
+import time
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+#
+# Exceptions we get from reading a segment which was cut short.
+#
+read_errors = (EOFError, )
+if zstandard:
+	read_errors = (EOFError, zstandard.ZstdError)
+
+
+#
+# This class appends records to the current segment of our archive,
+# and starts a new segment once the current one gets too big.
+#
+class Archive:
+
+	#
+	# Directory our segments are written to.
+	#
+	dir = ""
+
+	#
+	# Start a new segment after this many bytes (before compression).
+	#
+	max_bytes = 0
+
+	#
+	# The current segment, the file underneath it, and how much we have written to it.
+	#
+	file = None
+	raw = None
+	bytes_written = 0
+
+	#
+	# How many segments we have started, so that segment names stay
+	# unique even if we rotate more than once a second.
+	#
+	num_segments = 0
+
+	lock = None
+
+
+	def __init__(self, dir, max_bytes = 64 * 1024 * 1024):
+		self.dir = dir
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+
+		os.makedirs(self.dir, exist_ok = True)
+
+
+	#
+	# Start a new segment.
+	#
+	def open_segment(self):
+
+		filename = "{}/tweets-{}-{}-{:04d}.jsonl".format(self.dir,
+			time.strftime("%Y%m%d-%H%M%S", time.gmtime()), os.getpid(), self.num_segments)
+		self.num_segments += 1
+
+		if zstandard:
+			self.raw = open(filename + ".zst", "wb")
+			self.file = zstandard.ZstdCompressor().stream_writer(self.raw)
+		else:
+			self.raw = None
+			self.file = gzip.open(filename + ".gz", "wb")
+
+		self.bytes_written = 0
+		logger.info("Started archive segment {}".format(filename))
+
+
+	#
+	# Close the current segment, if there is one.
+	#
+	def close(self):
+
+		with self.lock:
+			self.close_segment()
+
+
+	def close_segment(self):
+
+		if not self.file:
+			return
+
+		self.file.close()
+		if self.raw:
+			self.raw.close()
+
+		self.file = None
+		self.raw = None
+
+
+	#
+	# Append a record to the archive.
+	#
+	# Each record is flushed as soon as it is written, so that a crash
+	# only ever loses the record being written at the time.
+	#
+	def write(self, record):
+
+		line = (json.dumps(record) + "\n").encode("utf-8")
+
+		with self.lock:
+
+			if not self.file:
+				self.open_segment()
+
+			self.file.write(line)
+			if zstandard:
+				self.file.flush(zstandard.FLUSH_FRAME)
+			else:
+				self.file.flush()
+
+			self.bytes_written += len(line)
+			if self.bytes_written >= self.max_bytes:
+				self.close_segment()
+
+
+	#
+	# Archive a page from a user's timeline.
+	#
+	def write_timeline(self, username, tweets):
+		self.write({"kind": "timeline", "username": username,
+			"time_t": int(time.time()), "tweets": tweets})
+
+
+	#
+	# Archive the original tweets we looked up when backfilling replies.
+	#
+	# errors - Dictionary of tweet IDs that we couldn't get, and the error for each.
+	#
+	def write_parents(self, tweets, errors = {}):
+		self.write({"kind": "parents", "time_t": int(time.time()),
+			"tweets": tweets, "errors": errors})
+
+
+#
+# Read every record in an archive, oldest segment first.
+#
+# The last segment may still be being written to, or may have been cut
+# short by a crash, so we stop at the first incomplete record.
+#
+def read_archive(dir):
+
+	filenames = sorted(glob.glob(dir + "/tweets-*.jsonl.gz") + glob.glob(dir + "/tweets-*.jsonl.zst"))
+
+	for filename in filenames:
+
+		logger.info("Reading archive segment {}".format(filename))
+
+		if filename.endswith(".zst"):
+			if not zstandard:
+				raise Exception("The zstandard module is needed to read {}".format(filename))
+			raw = open(filename, "rb")
+			file = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+				raw, read_across_frames = True))
+		else:
+			raw = None
+			file = gzip.open(filename, "rb")
+
+		try:
+			for line in file:
+				try:
+					yield(json.loads(line.decode("utf-8")))
+				except ValueError:
+					logger.warning("Skipping incomplete record at the end of {}".format(filename))
+
+		except read_errors:
+			logger.warning("Segment {} ends early, it may not have been closed".format(filename))
+
+		finally:
+			file.close()
+			if raw:
+				raw.close()
+
+
@@ -0,0 +1,466 @@
+#
+# In-memory, column-oriented copy of the tweets table, for reports.
+#
+# For each account we keep the few columns that our stats need in typed arrays,
+# sorted by time_t, which comes to about 21 bytes per tweet. A window is found
+# with a binary search on the time_t column, so reports don't depend on the database at all.
+#
+# The tweets are also split into blocks of a few thousand, and for each block we keep
+# its reply ages sorted in another typed array (4 bytes per backfilled reply), along
+# with its totals. A window's stats come from the blocks it covers, and only the
+# partial block at its start has to be looked at tweet by tweet. Percentiles are
+# found across the blocks' sorted reply ages with binary searches, so nothing is
+# sorted or copied per report. A block is only summarized again once it changes.
+#
+# The arrays are loaded once at startup and then kept up to date cheaply:
+#
+# - New tweets are found with a watermark on tweets.id, which only ever goes up,
+#	no matter what order tweets are fetched in. With several writers at once,
+#	as in Postgres, a lower ID can become visible after a higher one, so there
+#	we also look again at IDs just below the watermark, and skip tweets we already have.
+# - Replies are often backfilled after we load them, so for each account we remember
+#	the oldest tweet that was still waiting to be backfilled, and when the account's
+#	FetchState.version changes, we reload the reply ages from there on
+#
+
+import array
+import bisect
+import collections
+import logging as logger
+import threading
+import time
+
+from sqlalchemy.sql.expression import func
+
+from percentiles import SortedRuns
+from queries import get_pending_query, get_reply_ages_query
+from rollups import set_average
+from tables import FetchState, Tweets
+
+
+#
+# This class holds the columns for a single account.
+#
+class Columns:
+
+	tweet_id = None
+	time_t = None
+	reply_age = None
+
+	#
+	# 1 if the tweet is a reply, otherwise 0.
+	#
+	is_reply = None
+
+	#
+	# How many tweets are in each block.
+	#
+	block_size = 4096
+
+	#
+	# A summary of each block, as a tuple of its non-zero reply ages in a sorted array,
+	# its number of replies, and the sum of its reply ages. Blocks which have changed
+	# since they were last summarized are None, and so are any past the end of this list.
+	#
+	blocks = None
+
+
+	def __init__(self):
+		self.tweet_id = array.array("q")
+		self.time_t = array.array("q")
+		self.reply_age = array.array("i")
+		self.is_reply = array.array("b")
+		self.blocks = []
+
+
+	#
+	# Return how many bytes our arrays are using.
+	#
+	def get_size(self):
+
+		columns = [ self.tweet_id, self.time_t, self.reply_age, self.is_reply ]
+		columns += [ block[0] for block in self.blocks if block ]
+
+		return(sum([ len(column) * column.itemsize for column in columns ]))
+
+
+	#
+	# Forget our summary of the block that the tweet at index is in,
+	# or of every block from there on, when tweets have moved.
+	#
+	def forget(self, index, to_end = False):
+
+		block = index // self.block_size
+
+		if to_end:
+			del self.blocks[block:]
+		elif block < len(self.blocks):
+			self.blocks[block] = None
+
+
+	#
+	# Summarize the tweets from index start up to (but not including) end,
+	# in the same format as our blocks.
+	#
+	def summarize(self, start, end):
+
+		reply_ages = array.array("i", sorted(filter(None, self.reply_age[start:end])))
+		retval = (reply_ages, self.is_reply[start:end].count(1), sum(reply_ages))
+
+		return(retval)
+
+
+	#
+	# Return the summary of a block, summarizing it first if we need to.
+	#
+	def get_block(self, block):
+
+		while len(self.blocks) <= block:
+			self.blocks.append(None)
+
+		if self.blocks[block] is None:
+			start = block * self.block_size
+			self.blocks[block] = self.summarize(start, min(start + self.block_size, len(self.time_t)))
+
+		return(self.blocks[block])
+
+
+	#
+	# Add new tweets, as (tweet_id, time_t, is_reply, reply_age) tuples.
+	#
+	# New tweets are usually newer than everything we have and are just appended.
+	# Older ones (from going further back in an account's history, or pages fetched
+	# out of order) are merged in, which means rewriting everything after them.
+	#
+	def add(self, rows):
+
+		rows = sorted(rows, key = lambda row: (row[1], row[0]))
+		if not rows:
+			return
+
+		index = bisect.bisect_right(self.time_t, rows[0][1])
+		if index < len(self.time_t):
+			tail = list(zip(self.tweet_id[index:], self.time_t[index:],
+				self.is_reply[index:], self.reply_age[index:]))
+			rows = sorted(tail + rows, key = lambda row: (row[1], row[0]))
+			for column in [ self.tweet_id, self.time_t, self.is_reply, self.reply_age ]:
+				del column[index:]
+
+		self.forget(index, to_end = True)
+
+		(tweet_ids, times, is_replies, reply_ages) = zip(*rows)
+		self.tweet_id.extend(tweet_ids)
+		self.time_t.extend(times)
+		self.is_reply.extend(is_replies)
+		self.reply_age.extend(reply_ages)
+
+
+	#
+	# Append a tweet which is at least as new as every tweet we have.
+	#
+	def append(self, tweet_id, time_t, is_reply, reply_age):
+		self.tweet_id.append(tweet_id)
+		self.time_t.append(time_t)
+		self.is_reply.append(is_reply)
+		self.reply_age.append(reply_age)
+		self.forget(len(self.time_t) - 1)
+
+
+	#
+	# Return True if we already have a tweet.
+	#
+	def has(self, tweet_id, time_t):
+
+		index = bisect.bisect_left(self.time_t, time_t)
+		while index < len(self.time_t) and self.time_t[index] == time_t:
+			if self.tweet_id[index] == tweet_id:
+				return(True)
+			index += 1
+
+		return(False)
+
+
+	#
+	# Update the reply age of a tweet we already have.
+	#
+	def set_reply_age(self, tweet_id, time_t, reply_age):
+
+		index = bisect.bisect_left(self.time_t, time_t)
+		while index < len(self.time_t) and self.time_t[index] == time_t:
+			if self.tweet_id[index] == tweet_id:
+				if self.reply_age[index] != reply_age:
+					self.reply_age[index] = reply_age
+					self.forget(index)
+				return
+			index += 1
+
+
+	#
+	# Return our stats for tweets since a specific time,
+	# in the same format as rollups.get_rollup_stats().
+	#
+	# Reply ages are 0 until a reply is backfilled (and always 0 for tweets that
+	# aren't replies), so the non-zero reply ages are the ones that count.
+	#
+	def get_stats(self, start_time_t):
+
+		index = bisect.bisect_left(self.time_t, start_time_t)
+		end = len(self.time_t)
+
+		blocks = []
+		block = index // self.block_size
+		if index % self.block_size:
+			blocks.append(self.summarize(index, min((block + 1) * self.block_size, end)))
+			block += 1
+
+		while block * self.block_size < end:
+			blocks.append(self.get_block(block))
+			block += 1
+
+		runs = [ reply_ages for (reply_ages, num_replies, sum_reply_age) in blocks if reply_ages ]
+
+		retval = {
+			"num_tweets": end - index,
+			"num_tweets_reply": sum([ num_replies for (reply_ages, num_replies, sum_reply_age) in blocks ]),
+			"num_tweets_reply_timed": sum([ len(reply_ages) for reply_ages in runs ]),
+			"sum_reply_age": sum([ sum_reply_age for (reply_ages, num_replies, sum_reply_age) in blocks ]),
+			"min_reply_age": min([ reply_ages[0] for reply_ages in runs ]) if runs else None,
+			"max_reply_age": max([ reply_ages[-1] for reply_ages in runs ]) if runs else None,
+			"sketch": SortedRuns(runs),
+			}
+
+		set_average(retval)
+
+		return(retval)
+
+
+#
+# This class holds the columns for every account, and keeps them up to date.
+#
+class ColumnarCache:
+
+	#
+	# Our Columns objects, keyed by username.
+	#
+	accounts = None
+
+	#
+	# The highest tweets.id we have loaded.
+	#
+	watermark = 0
+
+	#
+	# Rows only become visible once the write they're in commits. SQLite only has one
+	# writer at a time, so that's always in tweets.id order, but with several writers
+	# a row can become visible after rows with higher IDs. Writes take seconds,
+	# so we assume any write commits within rescan_secs of starting.
+	#
+	# loads holds (start time, end time, watermark) for our recent loads. The next
+	# load looks at every ID above the watermark of the newest load which ended
+	# rescan_secs before our last load started, since anything we couldn't see
+	# in our last load was written after that.
+	#
+	# We don't know what was being written before our first load, so that load's
+	# watermark is recorded as rescan_ids lower than it was.
+	#
+	rescan_secs = 600
+	rescan_ids = 10000
+	loads = None
+
+	#
+	# Each account's FetchState.version as of our last refresh, and the lowest
+	# tweet ID which might still have its reply age change.
+	#
+	versions = None
+	pending = None
+
+	lock = None
+
+
+	def __init__(self):
+		self.accounts = {}
+		self.versions = {}
+		self.pending = {}
+		self.loads = collections.deque()
+		self.lock = threading.Lock()
+
+
+	#
+	# Return how many tweets we have, and how many bytes they're using.
+	#
+	def get_size(self):
+
+		num_tweets = sum([ len(columns.time_t) for columns in self.accounts.values() ])
+		num_bytes = sum([ columns.get_size() for columns in self.accounts.values() ])
+
+		return(num_tweets, num_bytes)
+
+
+	#
+	# Load any tweets we don't have yet, and any reply ages which have changed.
+	# The first call loads every tweet in the database.
+	#
+	def refresh(self, session):
+
+		with self.lock:
+
+			start = time.time()
+
+			#
+			# If nothing has been written or backfilled since last time, we're done.
+			# Writes bump their accounts' versions, so one that commits after a
+			# higher tweets.id is already visible is still noticed here.
+			#
+			versions = { row.username: row.version for row in
+				session.query(FetchState.username, FetchState.version) }
+			max_id = session.query(func.max(Tweets.id)).scalar() or 0
+
+			if versions == self.versions and max_id <= self.watermark:
+				return
+
+			#
+			# We check what's waiting to be backfilled before loading anything,
+			# so anything backfilled while we're loading is caught next time.
+			#
+			pending = {}
+			for row in get_pending_query(session):
+				pending[row.username] = min(pending.get(row.username) or row.tweet_id, row.tweet_id)
+
+			num_updated = self.update_reply_ages(session, versions)
+			num_loaded = self.load_tweets(session, pending)
+
+			self.versions = versions
+			self.pending = pending
+
+			if num_loaded or num_updated:
+				(num_tweets, num_bytes) = self.get_size()
+				logger.info("Loaded {} tweets and updated {} reply ages in {:.3f} seconds. "
+					"tweets={} bytes={} bytes_per_tweet={:.1f}".format(num_loaded, num_updated,
+					time.time() - start, num_tweets, num_bytes, num_bytes / max(num_tweets, 1)))
+
+
+	#
+	# Reload the reply ages of tweets that were waiting to be backfilled,
+	# for each account whose version has changed.
+	#
+	# Accounts without a FetchState row (which 1-fetch-tweets.py creates for
+	# every account it fetches) never look changed, so theirs aren't reloaded.
+	#
+	# Returns how many tweets we looked at.
+	#
+	def update_reply_ages(self, session, versions):
+
+		retval = 0
+
+		for username, tweet_id in self.pending.items():
+
+			if tweet_id is None or username not in self.accounts:
+				continue
+
+			if versions.get(username) == self.versions.get(username):
+				continue
+
+			for row in get_reply_ages_query(session, username, tweet_id):
+				self.accounts[username].set_reply_age(row.tweet_id, row.time_t, row.reply_age or 0)
+				retval += 1
+
+		return(retval)
+
+
+	#
+	# Return the tweets.id to load new rows above, and forget loads we no longer need.
+	#
+	def get_rescan_id(self):
+
+		last_start = self.loads[-1][0]
+		while len(self.loads) > 1 and self.loads[1][1] <= last_start - self.rescan_secs:
+			self.loads.popleft()
+
+		return(self.loads[0][2])
+
+
+	#
+	# Load tweets we haven't seen yet. Any of them which are replies that
+	# haven't been backfilled are added to our pending tweet IDs.
+	#
+	# On our first load, tweets are read account by account in time order
+	# and appended straight to our arrays, so we never hold more than one
+	# row at a time. After that, there are only a few new tweets each time,
+	# and those are read in the order they were written and then merged in.
+	#
+	# Returns how many tweets we loaded.
+	#
+	def load_tweets(self, session, pending):
+
+		retval = 0
+		rows = {}
+		start = time.time()
+
+		query = session.query(Tweets.id, Tweets.username, Tweets.tweet_id, Tweets.time_t,
+			Tweets.reply_tweet_id, Tweets.reply_age, Tweets.reply_time_t, Tweets.reply_error)
+
+		#
+		# A single query only sees the rows that were there when it started,
+		# so the highest ID we see is our new watermark.
+		#
+		serialized = session.get_bind().dialect.name == "sqlite"
+		first_load = not self.watermark
+		if first_load:
+			query = query.order_by(Tweets.username, Tweets.time_t)
+		elif serialized:
+			query = query.filter(Tweets.id > self.watermark)
+		else:
+			query = query.filter(Tweets.id > self.get_rescan_id())
+
+		for (id, username, tweet_id, time_t, reply_tweet_id, reply_age, reply_time_t,
+			reply_error) in session.execute(query.statement):
+
+			self.watermark = max(self.watermark, id)
+
+			if first_load:
+				if username not in self.accounts:
+					self.accounts[username] = Columns()
+
+			elif not serialized and username in self.accounts and self.accounts[username].has(tweet_id, time_t):
+				continue
+
+			is_reply = 0
+			if reply_tweet_id is not None:
+				is_reply = 1
+				if reply_time_t is None and reply_error is None:
+					pending[username] = min(pending.get(username) or tweet_id, tweet_id)
+
+			if first_load:
+				self.accounts[username].append(tweet_id, time_t, is_reply, reply_age or 0)
+			else:
+				rows.setdefault(username, []).append((tweet_id, time_t, is_reply, reply_age or 0))
+
+			retval += 1
+
+		for username, account_rows in rows.items():
+			self.accounts.setdefault(username, Columns()).add(account_rows)
+
+		if not serialized:
+			watermark = self.watermark
+			if first_load:
+				watermark = max(watermark - self.rescan_ids, 0)
+			self.loads.append((start, time.time(), watermark))
+
+		return(retval)
+
+
+	#
+	# Return the stats for a user's tweets since several different times,
+	# as a dictionary keyed by start time, just like get_rollup_stats_windows().
+	#
+	def get_stats(self, session, username, start_times):
+
+		self.refresh(session)
+
+		with self.lock:
+			columns = self.accounts.get(username, Columns())
+			retval = { start_time_t: columns.get_stats(start_time_t) for start_time_t in start_times }
+
+		return(retval)
+
+
@@ -85,6 +85,19 @@ class Config:
 		return(None)
 
 
+	#
+	# Return the value of a specific key as a list, split on commas and/or whitespace.
+	# An empty list is returned if the key isn't set.
+	#
+	def get_list(self, key):
+
+		value = self.get(key)
+		if not value:
+			return([])
+
+		return(value.replace(",", " ").split())
+
+
 	#
 	# Set the value of a specific key.
 	#
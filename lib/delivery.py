@@ -0,0 +1,369 @@
+#
+# A queue for delivering messages to Telegram in the background.
+#
+# Messages are sent by a small pool of threads straight to the Bot API, so a slow
+# or failing call to Telegram never holds up our reports. Each chat has its own
+# queue, so messages to one chat go out in order while several chats are sent to
+# at once, and we keep under Telegram's limits of 30 messages per second overall
+# and 1 per second to any one chat.
+#
+# Failed messages are retried with exponential backoff (or after however long
+# Telegram tells us to wait on a 429), and a message that is identical to one
+# already sent or queued to the same chat recently is dropped.
+#
+
+import collections
+import heapq
+import logging as logger
+import threading
+import time
+
+import requests
+
+
+#
+# Where the Bot API lives. Set telegram_api_url in config.ini to point us
+# at something else, such as bench/fake_telegram.py.
+#
+default_api_url = "https://api.telegram.org"
+
+
+#
+# Raised when Telegram tells us a message can't ever be sent, such as to a chat we're not in.
+#
+class DeliveryError(Exception):
+	pass
+
+
+#
+# Raised when a message might go through if we try again later.
+#
+# retry_after - How many seconds Telegram asked us to wait, if it did
+#
+class RetryError(Exception):
+
+	retry_after = None
+
+	def __init__(self, message, retry_after = None):
+		super().__init__(message)
+		self.retry_after = retry_after
+
+
+#
+# This class queues up messages and delivers them from background threads.
+#
+class Delivery:
+
+	#
+	# Our Bot API URL, including our token, such as https://api.telegram.org/bot<token>
+	#
+	url = None
+
+	#
+	# Our limits: how many messages a second we send overall, and the
+	# minimum number of seconds between two messages to the same chat.
+	#
+	messages_per_sec = 30
+	chat_interval = 1.0
+
+	#
+	# How many times we try to send a message before giving up, and how long we wait
+	# before the first retry. That wait doubles each time, up to backoff_max.
+	#
+	max_attempts = 5
+	backoff = 1.0
+	backoff_max = 60.0
+
+	#
+	# How many seconds to remember a message for, to drop identical ones.
+	#
+	dedup_secs = 300
+
+	#
+	# How many seconds to wait for Telegram to answer.
+	#
+	timeout = 10
+
+	#
+	# Queued messages for each chat, as dictionaries of chat_id, text, and attempts.
+	# Chat IDs are strings, just like they are in config.ini.
+	#
+	chats = None
+
+	#
+	# A heap of (time_t, chat_id) for chats with messages waiting, ordered by when
+	# each chat can next be sent to. A chat is in here at most once, and never
+	# while one of its messages is being sent.
+	#
+	ready = None
+	scheduled = None
+
+	#
+	# When we can next send to each chat, and when we can next send anything at all.
+	#
+	chat_next = None
+	global_next = 0
+
+	#
+	# When we last queued each (chat_id, text), for dropping duplicates.
+	#
+	recent = None
+
+	#
+	# How many messages are queued or being sent.
+	#
+	pending = 0
+
+	#
+	# Counts of what has happened to our messages.
+	#
+	stats = None
+
+	threads = None
+	condition = None
+	stopping = False
+
+
+	#
+	# token - Our bot's token
+	# api_url - The Bot API to send to, without a trailing slash
+	# num_threads - How many messages we can be sending at once
+	#
+	def __init__(self, token, api_url = None, num_threads = 8, messages_per_sec = 30,
+		chat_interval = 1.0, max_attempts = 5, dedup_secs = 300):
+
+		self.url = "{}/bot{}".format(api_url or default_api_url, token)
+		self.messages_per_sec = messages_per_sec
+		self.chat_interval = chat_interval
+		self.max_attempts = max_attempts
+		self.dedup_secs = dedup_secs
+
+		self.chats = {}
+		self.ready = []
+		self.scheduled = set()
+		self.chat_next = {}
+		self.recent = {}
+		self.stats = {"queued": 0, "sent": 0, "retried": 0, "failed": 0, "duplicate": 0}
+		self.condition = threading.Condition()
+
+		self.threads = []
+		for i in range(num_threads):
+			thread = threading.Thread(target = self.run, name = "delivery-{}".format(i), daemon = True)
+			thread.start()
+			self.threads.append(thread)
+
+
+	#
+	# Queue a message to one or more chats. This returns right away.
+	#
+	# Returns how many messages were queued, which leaves out duplicates.
+	#
+	def send(self, chat_ids, text):
+
+		retval = 0
+
+		with self.condition:
+
+			now = time.time()
+			self.recent = { key: time_t for key, time_t in self.recent.items()
+				if time_t > now - self.dedup_secs }
+
+			for chat_id in chat_ids:
+
+				key = (chat_id, text)
+				if key in self.recent:
+					self.stats["duplicate"] += 1
+					logger.info("Not sending a duplicate message to chat {}".format(chat_id))
+					continue
+
+				self.recent[key] = now
+				self.chats.setdefault(chat_id, collections.deque()).append(
+					{"chat_id": chat_id, "text": text, "attempts": 0})
+				self.schedule(chat_id, now)
+				self.pending += 1
+				self.stats["queued"] += 1
+				retval += 1
+
+			self.condition.notify_all()
+
+		return(retval)
+
+
+	#
+	# Put a chat into our ready heap, if it isn't there already.
+	# Call this with our condition held.
+	#
+	def schedule(self, chat_id, now):
+
+		if chat_id in self.scheduled:
+			return
+
+		self.scheduled.add(chat_id)
+		heapq.heappush(self.ready, (max(now, self.chat_next.get(chat_id, 0)), chat_id))
+
+
+	#
+	# Wait for the next message that we're allowed to send and take it off its chat's queue.
+	#
+	# We reserve a slot against our overall limit before returning, so threads
+	# line up behind each other. Returns the message and when it can be sent,
+	# or None if we're stopping.
+	#
+	def get_next(self):
+
+		with self.condition:
+
+			while True:
+
+				if self.stopping:
+					return(None)
+
+				now = time.time()
+				if self.ready and self.ready[0][0] <= now:
+					break
+
+				timeout = None
+				if self.ready:
+					timeout = self.ready[0][0] - now
+				self.condition.wait(timeout)
+
+			(time_t, chat_id) = heapq.heappop(self.ready)
+			message = self.chats[chat_id].popleft()
+
+			send_time_t = max(now, self.global_next)
+			self.global_next = send_time_t + 1 / self.messages_per_sec
+
+		return(message, send_time_t)
+
+
+	#
+	# Our threads run this, sending messages until we're stopped.
+	#
+	def run(self):
+
+		while True:
+
+			item = self.get_next()
+			if not item:
+				return
+
+			(message, send_time_t) = item
+			sleep_secs = send_time_t - time.time()
+			if sleep_secs > 0:
+				time.sleep(sleep_secs)
+
+			retry_time_t = None
+
+			try:
+				message["attempts"] += 1
+				self.post(message["chat_id"], message["text"])
+				result = "sent"
+
+			except RetryError as e:
+				result = "retried"
+				if message["attempts"] >= self.max_attempts:
+					result = "failed"
+
+				wait = e.retry_after
+				if wait is None:
+					wait = min(self.backoff * 2 ** (message["attempts"] - 1), self.backoff_max)
+				retry_time_t = time.time() + wait
+
+				logger.warning("Unable to send message to chat {} (attempt {} of {}): {}".format(
+					message["chat_id"], message["attempts"], self.max_attempts, e))
+
+			except DeliveryError as e:
+				result = "failed"
+				logger.error("Unable to send message to chat {}: {}".format(message["chat_id"], e))
+
+			self.finish(message, result, retry_time_t)
+
+
+	#
+	# Record what happened to a message, and let its chat send its next one.
+	#
+	def finish(self, message, result, retry_time_t):
+
+		chat_id = message["chat_id"]
+
+		with self.condition:
+
+			now = time.time()
+			self.stats[result] += 1
+			self.scheduled.discard(chat_id)
+			self.chat_next[chat_id] = max(now + self.chat_interval, retry_time_t or 0)
+
+			if result == "retried":
+				self.chats[chat_id].appendleft(message)
+
+			else:
+				self.pending -= 1
+				#
+				# If we gave up on a message, let it be sent again if it's queued again.
+				#
+				if result == "failed":
+					self.recent.pop((chat_id, message["text"]), None)
+
+			if self.chats[chat_id]:
+				self.schedule(chat_id, now)
+			else:
+				del self.chats[chat_id]
+
+			self.condition.notify_all()
+
+
+	#
+	# Send a single message with the Bot API.
+	#
+	def post(self, chat_id, text):
+
+		try:
+			r = requests.post(self.url + "/sendMessage", json = {"chat_id": chat_id, "text": text},
+				timeout = self.timeout)
+		except requests.exceptions.RequestException as e:
+			raise RetryError(e)
+
+		if r.status_code == 200:
+			return
+
+		try:
+			data = r.json()
+		except ValueError:
+			data = {}
+
+		description = "HTTP {}: {}".format(r.status_code, data.get("description", r.reason))
+
+		if r.status_code == 429:
+			raise RetryError(description, (data.get("parameters") or {}).get("retry_after"))
+
+		if r.status_code >= 500:
+			raise RetryError(description)
+
+		raise DeliveryError(description)
+
+
+	#
+	# Wait until every queued message has been sent or given up on.
+	#
+	# Returns False if we were still waiting after timeout seconds.
+	#
+	def flush(self, timeout = None):
+
+		with self.condition:
+			return(self.condition.wait_for(lambda: not self.pending, timeout))
+
+
+	#
+	# Stop our threads once they're done with what they're sending.
+	# Anything still queued is dropped.
+	#
+	def stop(self):
+
+		with self.condition:
+			self.stopping = True
+			self.condition.notify_all()
+
+		for thread in self.threads:
+			thread.join()
+
+
@@ -0,0 +1,115 @@
+#
+# Let the Telegram bot know as soon as new data lands.
+#
+# The fetcher sends a datagram with the usernames it just wrote or backfilled
+# tweets for to a Unix socket next to our database, and the bot (if it was run
+# with --on-new-data) listens on that socket instead of polling the database.
+# Nobody has to be listening: if the bot isn't running, notifications are dropped.
+#
+
+import logging as logger
+import os
+import select
+import socket
+
+
+#
+# Where our socket lives. This is relative, just like tweets.db,
+# so the fetcher and the bot have to be run from the same directory.
+#
+socket_path = "tweets.sock"
+
+#
+# The largest datagram we'll send, which is plenty for a list of usernames.
+#
+max_size = 4096
+
+#
+# The socket we send notifications from, created on first use.
+#
+sender = None
+
+
+#
+# Tell anyone listening that some accounts have new data.
+# This never blocks, and never fails because nobody is listening.
+#
+def notify(usernames, path = socket_path):
+
+	global sender
+
+	usernames = sorted(set(usernames))
+	if not usernames:
+		return
+
+	if not sender:
+		sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		sender.setblocking(False)
+
+	try:
+		sender.sendto(" ".join(usernames).encode("utf-8")[:max_size], path)
+
+	except (FileNotFoundError, ConnectionRefusedError, BlockingIOError) as e:
+		logger.debug("Nobody is listening for notifications on {}: {}".format(path, e))
+
+
+#
+# This class listens for notifications from notify().
+#
+class Listener:
+
+	path = None
+	socket = None
+
+
+	#
+	# Bind our socket, replacing the socket file from any earlier run.
+	#
+	def __init__(self, path = socket_path):
+
+		self.path = path
+
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		self.socket.bind(self.path)
+		self.socket.setblocking(False)
+
+		logger.info("Listening for new data notifications on {}".format(self.path))
+
+
+	#
+	# Wait up to timeout seconds for notifications.
+	#
+	# Returns the set of usernames we were told about, which is empty if we timed out.
+	# Every notification which has arrived is read, so a burst of them is handled at once.
+	#
+	def wait(self, timeout):
+
+		retval = set()
+
+		(readable, writable, errored) = select.select([ self.socket ], [], [], max(timeout, 0))
+		if not readable:
+			return(retval)
+
+		while True:
+			try:
+				data = self.socket.recv(max_size)
+			except BlockingIOError:
+				break
+			retval.update(data.decode("utf-8").split())
+
+		return(retval)
+
+
+	#
+	# Stop listening and remove our socket file.
+	#
+	def close(self):
+
+		self.socket.close()
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+
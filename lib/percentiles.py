@@ -0,0 +1,115 @@
+#
+# Helpers for calculating percentiles.
+#
+# We use linear interpolation between the two closest ranks, so the 50th
+# percentile of an even number of values is the average of the middle two,
+# which is what our median has always been.
+#
+
+import bisect
+import math
+
+
+#
+# Return the 0-based ranks of the two values that a percentile falls
+# between, and how far between them it is.
+#
+# num_values - How many values there are in total
+# percentile - The percentile to calculate, from 0 to 100
+#
+def get_ranks(num_values, percentile):
+
+	position = (num_values - 1) * percentile / 100
+	low = math.floor(position)
+	high = math.ceil(position)
+
+	return(low, high, position - low)
+
+
+#
+# Return every 0-based rank that we need values for to calculate a list of percentiles.
+#
+def get_all_ranks(num_values, percentiles):
+
+	retval = set()
+
+	for percentile in percentiles:
+		(low, high, fraction) = get_ranks(num_values, percentile)
+		retval.add(low)
+		retval.add(high)
+
+	return(sorted(retval))
+
+
+#
+# Calculate percentiles from a dictionary of values keyed by their 0-based rank.
+#
+# Returns a dictionary of values keyed by percentile.
+#
+def interpolate(num_values, percentiles, values):
+
+	retval = {}
+
+	for percentile in percentiles:
+		(low, high, fraction) = get_ranks(num_values, percentile)
+		retval[percentile] = values[low] + (values[high] - values[low]) * fraction
+
+	return(retval)
+
+
+#
+# This class holds several sorted lists of whole numbers, and calculates exact
+# percentiles across all of them without merging them into one list.
+# It has the same get_percentile() as sketch.Sketch, so either can be used in our stats.
+#
+# Each value is found with a binary search on the value itself: how many values
+# are at or below a guess is a binary search in each list, so each percentile costs
+# about log2(largest value) * number of lists * log2(size of each list).
+#
+class SortedRuns:
+
+	runs = None
+	num_values = 0
+
+
+	def __init__(self, runs):
+		self.runs = [ run for run in runs if len(run) ]
+		self.num_values = sum([ len(run) for run in self.runs ])
+
+
+	#
+	# Return the value at a 0-based rank, counting from the smallest value.
+	#
+	def get_value(self, rank):
+
+		low = min([ run[0] for run in self.runs ])
+		high = max([ run[-1] for run in self.runs ])
+
+		while low < high:
+			middle = (low + high) // 2
+			if sum([ bisect.bisect_right(run, middle) for run in self.runs ]) > rank:
+				high = middle
+			else:
+				low = middle + 1
+
+		return(low)
+
+
+	#
+	# Return a percentile, from 0 to 100, or None if there are no values.
+	#
+	def get_percentile(self, percentile):
+
+		if not self.num_values:
+			return(None)
+
+		(low, high, fraction) = get_ranks(self.num_values, percentile)
+		low_value = self.get_value(low)
+		high_value = low_value
+		if high != low:
+			high_value = self.get_value(high)
+
+		retval = low_value + (high_value - low_value) * fraction
+
+		return(retval)
+
@@ -0,0 +1,340 @@
+#
+# Queries that are shared between our scripts.
+#
+# Keeping the filters for our hot queries in one place means the indexes
+# in tables.py and the queries that rely on them can't drift apart, and
+# lets check_query_plans() verify that none of them fall back to a table scan.
+#
+
+import re
+
+from sqlalchemy.sql.expression import and_, case, func, text
+
+from percentiles import get_all_ranks, interpolate
+from tables import Rollups, Tweets
+
+
+#
+# Filter a query down to tweets from a user since a specific time.
+#
+def filter_window(query, username, start_time_t):
+	return(query.filter(Tweets.username == username).filter(
+		Tweets.time_t >= start_time_t))
+
+
+#
+# Filter a query down to tweets that were replies and have had their reply age backfilled.
+#
+def filter_replies(query):
+	return(query.filter(Tweets.reply_tweet_id != None).filter(Tweets.reply_age != 0))
+
+
+#
+# Filter a query down to tweets that are replies which we haven't
+# tried to look up the original tweet for yet.
+#
+# These filters need to match the WHERE clause on ix_tweets_backfill
+# exactly, otherwise SQLite won't use that partial index.
+#
+def filter_backfill(query):
+	return(query.filter(Tweets.reply_tweet_id != None).filter(
+		Tweets.reply_error == None).filter(Tweets.reply_time_t == None))
+
+
+#
+# Filter a query down to tweets whose original tweet we couldn't fetch.
+# This needs to match the WHERE clause on ix_tweets_reply_error.
+#
+def filter_reply_error(query):
+	return(query.filter(Tweets.reply_error != None))
+
+
+#
+# Return a query for the username and tweet ID of each tweet waiting to be backfilled.
+#
+# There are only ever a few of these, so they are read straight out of ix_tweets_backfill.
+# Grouping them by username in the database instead can lead SQLite to scan
+# ix_tweets_username_time_t, when it hasn't gathered stats on the table with ANALYZE.
+#
+def get_pending_query(session):
+	return(filter_backfill(session.query(Tweets.username, Tweets.tweet_id)))
+
+
+#
+# Return a query for the reply ages of a user's replies from a tweet ID onwards.
+#
+def get_reply_ages_query(session, username, tweet_id):
+	return(session.query(Tweets.tweet_id, Tweets.time_t, Tweets.reply_age).filter(
+		Tweets.username == username).filter(Tweets.tweet_id >= tweet_id).filter(
+		Tweets.reply_tweet_id != None))
+
+
+#
+# Filter a query on our rollups down to a user's buckets from a specific bucket onwards.
+#
+def filter_buckets(query, username, bucket_time_t):
+	return(query.filter(Rollups.username == username).filter(
+		Rollups.bucket_time_t >= bucket_time_t))
+
+
+#
+# Return a query which adds up a user's rollups for several windows in one pass.
+#
+# For each window there are six columns: the sums of num_tweets, num_tweets_reply,
+# num_tweets_reply_timed and sum_reply_age, and the min and max reply ages.
+#
+# boundaries - A list of the first whole bucket in each window
+#
+def get_rollup_totals_query(session, username, boundaries):
+
+	columns = []
+	for boundary in boundaries:
+		in_window = Rollups.bucket_time_t >= boundary
+		columns += [
+			func.coalesce(func.sum(case([(in_window, Rollups.num_tweets)], else_ = 0)), 0),
+			func.coalesce(func.sum(case([(in_window, Rollups.num_tweets_reply)], else_ = 0)), 0),
+			func.coalesce(func.sum(case([(in_window, Rollups.num_tweets_reply_timed)], else_ = 0)), 0),
+			func.coalesce(func.sum(case([(in_window, Rollups.sum_reply_age)], else_ = 0)), 0),
+			func.min(case([(in_window, Rollups.min_reply_age)])),
+			func.max(case([(in_window, Rollups.max_reply_age)])),
+			]
+
+	retval = filter_buckets(session.query(*columns), username, min(boundaries))
+
+	return(retval)
+
+
+#
+# Return a query for the sketches of a user's buckets which have backfilled
+# replies in them, from a specific bucket onwards, newest first.
+#
+def get_rollup_sketches_query(session, username, bucket_time_t):
+	return(filter_buckets(session.query(Rollups.bucket_time_t, Rollups.sketch),
+		username, bucket_time_t).filter(Rollups.num_tweets_reply_timed > 0).order_by(
+		Rollups.bucket_time_t.desc()))
+
+
+#
+# Return the maximum Tweet ID or None if there are no tweets.
+#
+def get_max_tweet_id(session, username):
+
+	retval = None
+	row = session.query(func.max(Tweets.tweet_id).label("max")).filter(
+		Tweets.username == username).first()
+
+	if row:
+		retval = row.max
+
+	return(retval)
+
+
+#
+# Return the minimum Tweet ID or None if there are no tweets.
+#
+def get_min_tweet_id(session, username):
+
+	retval = None
+	row = session.query(func.min(Tweets.tweet_id).label("min")).filter(
+		Tweets.username == username).first()
+
+	if row:
+		retval = row.min
+
+	return(retval)
+
+
+#
+# Return the most recent tweet from a user, or None if there are no tweets.
+#
+def get_last_tweet(session, username):
+	return(session.query(Tweets).filter(
+		Tweets.username == username).order_by(
+		Tweets.tweet_id.desc()).first())
+
+
+#
+# Return a query which calculates all of our stats for a user's tweets
+# since a specific time in a single pass over the index.
+#
+# Conditional aggregates let the reply stats share the same scan as the tweet counts.
+#
+def get_window_stats_query(session, username, start_time_t):
+
+	is_reply = Tweets.reply_tweet_id != None
+	is_timed = and_(is_reply, Tweets.reply_age != 0)
+
+	retval = filter_window(session.query(
+		func.count(Tweets.tweet_id).label("num_tweets"),
+		func.sum(case([(is_reply, 1)], else_ = 0)).label("num_tweets_reply"),
+		func.sum(case([(is_timed, 1)], else_ = 0)).label("num_tweets_reply_timed"),
+		func.min(case([(is_timed, Tweets.reply_age)])).label("min_reply_age"),
+		func.max(case([(is_timed, Tweets.reply_age)])).label("max_reply_age"),
+		func.avg(case([(is_timed, Tweets.reply_age)])).label("avg_reply_age"),
+		), username, start_time_t)
+
+	return(retval)
+
+
+#
+# Run get_window_stats_query() and return the results as a dictionary.
+#
+# num_tweets_reply_timed is how many replies we know the reply time of,
+# and the min/max/avg reply ages are None if that is zero.
+#
+def get_window_stats(session, username, start_time_t):
+
+	row = get_window_stats_query(session, username, start_time_t).first()
+
+	#
+	# Postgres averages integers into a Decimal, which we don't want to do math with.
+	#
+	avg_reply_age = row.avg_reply_age
+	if avg_reply_age is not None:
+		avg_reply_age = float(avg_reply_age)
+
+	retval = {
+		"num_tweets": row.num_tweets or 0,
+		"num_tweets_reply": row.num_tweets_reply or 0,
+		"num_tweets_reply_timed": row.num_tweets_reply_timed or 0,
+		"min_reply_age": row.min_reply_age,
+		"max_reply_age": row.max_reply_age,
+		"avg_reply_age": avg_reply_age,
+		}
+
+	return(retval)
+
+
+#
+# Return a query which numbers the backfilled reply ages of a user's
+# tweets since a specific time, from 0 for the fastest reply.
+#
+def get_reply_ranks_query(session, username, start_time_t):
+
+	retval = filter_replies(filter_window(session.query(
+		Tweets.reply_age.label("reply_age"),
+		(func.row_number().over(order_by = Tweets.reply_age) - 1).label("rank"),
+		), username, start_time_t))
+
+	return(retval)
+
+
+#
+# Calculate percentiles of the reply ages of a user's tweets since a specific time.
+#
+# The database sorts the reply ages and hands back only the handful of
+# rows at the ranks we need, so no matter how many replies there are,
+# we never hold more than two values per percentile in memory.
+#
+# percentiles - List of percentiles to calculate, from 0 to 100
+# num_replies - How many backfilled replies there are, if we already know (from get_window_stats())
+#
+# Returns a dictionary of reply ages keyed by percentile, which is empty if there are no replies.
+#
+def get_reply_percentiles(session, username, start_time_t, percentiles, num_replies = None):
+
+	if num_replies is None:
+		num_replies = get_window_stats(session, username, start_time_t)["num_tweets_reply_timed"]
+
+	if not num_replies:
+		return({})
+
+	ranks = get_all_ranks(num_replies, percentiles)
+
+	ranked = get_reply_ranks_query(session, username, start_time_t).subquery()
+	rows = session.query(ranked.c.rank, ranked.c.reply_age).filter(
+		ranked.c.rank.in_(ranks))
+
+	values = { row.rank: row.reply_age for row in rows }
+
+	retval = interpolate(num_replies, percentiles, values)
+
+	return(retval)
+
+
+#
+# Return a dictionary of our hot queries, keyed by name, for checking query plans.
+#
+def get_hot_queries(session, username = "username", start_time_t = 0):
+
+	retval = {}
+
+	retval["window_stats"] = get_window_stats_query(session, username, start_time_t)
+	retval["reply_ranks"] = get_reply_ranks_query(session, username, start_time_t)
+	retval["last_tweet"] = session.query(Tweets).filter(
+		Tweets.username == username).order_by(Tweets.tweet_id.desc()).limit(1)
+	retval["max_tweet_id"] = session.query(func.max(Tweets.tweet_id)).filter(
+		Tweets.username == username)
+	retval["min_tweet_id"] = session.query(func.min(Tweets.tweet_id)).filter(
+		Tweets.username == username)
+	retval["backfill"] = filter_backfill(session.query(Tweets))
+	retval["retry_reply_errors"] = filter_reply_error(session.query(Tweets)).filter(
+		Tweets.reply_tweet_id.in_([ 1, 2 ]))
+	retval["pending"] = get_pending_query(session)
+	retval["reply_ages"] = get_reply_ages_query(session, username, 0)
+	retval["rollup_totals"] = get_rollup_totals_query(session, username, [ start_time_t ])
+	retval["rollup_sketches"] = get_rollup_sketches_query(session, username, start_time_t)
+
+	return(retval)
+
+
+#
+# Run EXPLAIN QUERY PLAN (or EXPLAIN in Postgres) on a query and return the detail string of each step.
+#
+def explain(session, query):
+
+	dialect = session.get_bind().dialect
+
+	sql = str(query.statement.compile(dialect = dialect,
+		compile_kwargs = {"literal_binds": True}))
+
+	if dialect.name == "sqlite":
+		rows = session.execute(text("EXPLAIN QUERY PLAN " + sql))
+	else:
+		rows = session.execute(text("EXPLAIN " + sql))
+
+	retval = [ row[len(row) - 1].strip() for row in rows ]
+
+	return(retval)
+
+
+#
+# Check the plan of each of our hot queries.
+#
+# A query fails if it scans the tweets or rollups table, unless the scan is over
+# a partial index (which only holds the rows we're looking for anyway).
+# Postgres only ever scans a partial index through the index, so any
+# sequential scan of either table fails there.
+#
+# Returns a dictionary of failing query names and their plans.
+#
+def check_query_plans(session):
+
+	retval = {}
+
+	if session.get_bind().dialect.name == "sqlite":
+		scan = r"SCAN (TABLE )?(tweets|rollups)\b"
+	else:
+		scan = r"(->\s*)?Seq Scan on (tweets|rollups)\b"
+
+	partial_indexes = [ index.name for index in Tweets.__table__.indexes
+		if index.dialect_options["sqlite"]["where"] is not None ]
+
+	for name, query in get_hot_queries(session).items():
+
+		plan = explain(session, query)
+
+		for step in plan:
+
+			if not re.match(scan, step):
+				continue
+
+			match = re.search(r"USING (COVERING )?INDEX (\w+)", step)
+			if match and match.group(2) in partial_indexes:
+				continue
+
+			retval[name] = plan
+
+	return(retval)
+
+
@@ -0,0 +1,142 @@
+import logging as logger
+import threading
+import time
+
+import twython
+
+
+#
+# This class keeps track of how much of the Twitter API's rate limit we have
+# left for each endpoint, and paces our calls so that they're spread out
+# evenly over each rate limit window instead of running into a 429.
+#
+# It is safe to share between threads, so that several threads fetching
+# at once share a single budget.
+#
+class RateLimiter:
+
+	#
+	# Our endpoints, keyed by name. Each one is a dictionary with
+	# the remaining calls, the time_t the window resets, and when we last called it.
+	#
+	endpoints = None
+
+	#
+	# Lock around our endpoint state
+	#
+	lock = None
+
+
+	def __init__(self):
+		self.endpoints = {}
+		self.lock = threading.Lock()
+
+
+	#
+	# Return the state for an endpoint, creating it if we haven't seen it before.
+	#
+	def get_endpoint(self, endpoint):
+
+		if not endpoint in self.endpoints:
+			self.endpoints[endpoint] = {"remaining": None, "reset": None, "last": 0}
+
+		return(self.endpoints[endpoint])
+
+
+	#
+	# Record the rate limit headers from the last call we made with this Twitter object.
+	#
+	def update(self, twitter, endpoint):
+
+		remaining = twitter.get_lastfunction_header("x-rate-limit-remaining")
+		reset = twitter.get_lastfunction_header("x-rate-limit-reset")
+
+		with self.lock:
+			state = self.get_endpoint(endpoint)
+			if remaining is not None:
+				state["remaining"] = int(remaining)
+			if reset is not None:
+				state["reset"] = int(reset)
+
+
+	#
+	# Return how many seconds we should wait before calling an endpoint again.
+	#
+	# If we're out of calls, that's until the window resets. Otherwise we spread our
+	# remaining calls evenly over what's left of the window, so that when we have
+	# plenty of quota we barely wait at all.
+	#
+	def get_wait(self, endpoint):
+
+		state = self.get_endpoint(endpoint)
+		now = time.time()
+
+		if state["remaining"] is None or state["reset"] is None or state["reset"] <= now:
+			return(0)
+
+		if state["remaining"] <= 0:
+			#
+			# Add a second in case our clock is a little behind Twitter's.
+			#
+			return(state["reset"] - now + 1)
+
+		interval = (state["reset"] - now) / state["remaining"]
+		retval = state["last"] + interval - now
+
+		return(max(retval, 0))
+
+
+	#
+	# Sleep until we're allowed to call an endpoint.
+	#
+	# Our slot is reserved before sleeping, so that other threads
+	# waiting on the same endpoint line up behind us.
+	#
+	def wait(self, endpoint):
+
+		with self.lock:
+			sleep_secs = self.get_wait(endpoint)
+			state = self.get_endpoint(endpoint)
+			state["last"] = time.time() + sleep_secs
+			if state["remaining"]:
+				state["remaining"] -= 1
+
+		if sleep_secs >= 1:
+			logger.info("Rate limiting {}: sleeping for {:.1f} seconds".format(
+				endpoint, sleep_secs))
+
+		if sleep_secs > 0:
+			time.sleep(sleep_secs)
+
+
+	#
+	# Call a Twitter API function, pacing it against that endpoint's rate limit.
+	# If we get a 429 anyway, we sleep until the window resets and try again.
+	#
+	# twitter - Our Twython object
+	# endpoint - Name of the endpoint, used to track its rate limit
+	# func - The function to call, such as twitter.get_user_timeline
+	#
+	def call(self, twitter, endpoint, func, **kwargs):
+
+		while True:
+
+			self.wait(endpoint)
+
+			try:
+				retval = func(**kwargs)
+
+			except twython.exceptions.TwythonRateLimitError as e:
+				with self.lock:
+					state = self.get_endpoint(endpoint)
+					state["remaining"] = 0
+					state["reset"] = int(e.retry_after or time.time() + 60)
+				logger.warning("Got rate limited on {}, retrying after {}".format(
+					endpoint, state["reset"]))
+				continue
+
+			self.update(twitter, endpoint)
+
+			return(retval)
+
+
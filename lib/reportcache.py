@@ -0,0 +1,114 @@
+#
+# Cache of the data behind our reports.
+#
+# A report's data only changes if the account's tweets were written or
+# backfilled (which bumps FetchState.version), or if the start of one of its
+# windows moved past some of its tweets. If neither has happened since we last
+# built a report, we can send the same data again without running any queries
+# other than the two cheap ones needed to check that.
+#
+
+import logging as logger
+
+from queries import filter_window
+from tables import FetchState, Tweets
+
+
+#
+# Return the version of an account's data, or None if we don't know it.
+#
+def get_data_version(session, username):
+
+	retval = None
+	row = session.query(FetchState.version).filter(FetchState.username == username).first()
+
+	if row:
+		retval = row.version or 0
+
+	return(retval)
+
+
+#
+# This class holds the data of the last report for each account and window.
+#
+class ReportCache:
+
+	#
+	# Our cached reports, keyed by (username, window names).
+	# Each one is a dictionary with the version and start times of its data.
+	#
+	entries = None
+
+	#
+	# How many times we've been able to use our cache, and how many times we haven't.
+	#
+	hits = 0
+	misses = 0
+
+
+	def __init__(self):
+		self.entries = {}
+
+
+	#
+	# Return the data for a report, using our cache if we can,
+	# and otherwise calling func(username, start_times) and caching that.
+	#
+	# name - The name of the report's windows, such as ("6 hours ago", "1 day ago")
+	# start_times - The start of each of the report's windows
+	#
+	def get(self, session, name, username, start_times, func):
+
+		#
+		# We get the version before running any queries, so if tweets are
+		# written while we're building the report, we'll just build it again next time.
+		#
+		version = get_data_version(session, username)
+
+		key = (username, name)
+		entry = self.entries.get(key)
+
+		if self.is_valid(session, entry, username, start_times, version):
+			self.hits += 1
+			logger.info("Using cached report for {} ({}) version={} hits={} misses={}".format(
+				username, name, version, self.hits, self.misses))
+			entry["start_times"] = start_times
+			return(entry["data"])
+
+		self.misses += 1
+		retval = func(username, start_times)
+
+		if version is not None:
+			self.entries[key] = {"version": version, "start_times": start_times, "data": retval}
+
+		return(retval)
+
+
+	#
+	# Return True if a cache entry can be used for windows starting at start_times.
+	#
+	def is_valid(self, session, entry, username, start_times, version):
+
+		if not entry or version is None or entry["version"] != version:
+			return(False)
+
+		for (old_start_time_t, start_time_t) in zip(entry["start_times"], start_times):
+
+			if start_time_t < old_start_time_t:
+				return(False)
+
+			if start_time_t == old_start_time_t:
+				continue
+
+			#
+			# This window has moved forward, which is fine as long as no tweets fell out of it.
+			#
+			row = filter_window(session.query(Tweets.id), username, old_start_time_t).filter(
+				Tweets.time_t < start_time_t).first()
+
+			if row:
+				return(False)
+
+		return(True)
+
+
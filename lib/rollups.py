@@ -0,0 +1,304 @@
+#
+# Per-hour rollups of each account's tweets.
+#
+# Whenever tweets are written or backfilled, the hours they fall in are
+# recalculated from the tweets table and saved to the rollups table.
+# Reports then answer any window by adding up the rollups of the hours
+# it covers, plus the raw tweets in the partial hour at its start.
+#
+
+import logging as logger
+import time
+
+from queries import filter_window, get_rollup_sketches_query, get_rollup_totals_query
+from sketch import from_json, Sketch
+from tables import Rollups, Tweets
+
+
+#
+# How many seconds each rollup covers.
+#
+bucket_size = 3600
+
+
+#
+# Return the start of the bucket that a time_t falls in.
+#
+def get_bucket(time_t):
+	return(time_t - time_t % bucket_size)
+
+
+#
+# Return empty stats, for adding tweets or other stats to.
+#
+def get_empty_stats():
+
+	retval = {
+		"num_tweets": 0,
+		"num_tweets_reply": 0,
+		"num_tweets_reply_timed": 0,
+		"sum_reply_age": 0,
+		"min_reply_age": None,
+		"max_reply_age": None,
+		"sketch": Sketch(),
+		}
+
+	return(retval)
+
+
+#
+# Add a tweet to our stats.
+#
+# A reply only counts towards the reply ages once it has been backfilled,
+# which is the same rule that filter_replies() uses.
+#
+def add_tweet(stats, reply_tweet_id, reply_age):
+
+	stats["num_tweets"] += 1
+
+	if reply_tweet_id is None:
+		return
+
+	stats["num_tweets_reply"] += 1
+
+	if not reply_age:
+		return
+
+	stats["num_tweets_reply_timed"] += 1
+	stats["sum_reply_age"] += reply_age
+	if stats["min_reply_age"] is None or reply_age < stats["min_reply_age"]:
+		stats["min_reply_age"] = reply_age
+	if stats["max_reply_age"] is None or reply_age > stats["max_reply_age"]:
+		stats["max_reply_age"] = reply_age
+	stats["sketch"].add(reply_age)
+
+
+#
+# Add one set of stats into another.
+#
+def merge_stats(stats, other):
+
+	for key in [ "num_tweets", "num_tweets_reply", "num_tweets_reply_timed", "sum_reply_age" ]:
+		stats[key] += other[key]
+
+	if other["min_reply_age"] is not None:
+		if stats["min_reply_age"] is None or other["min_reply_age"] < stats["min_reply_age"]:
+			stats["min_reply_age"] = other["min_reply_age"]
+
+	if other["max_reply_age"] is not None:
+		if stats["max_reply_age"] is None or other["max_reply_age"] > stats["max_reply_age"]:
+			stats["max_reply_age"] = other["max_reply_age"]
+
+	stats["sketch"].merge(other["sketch"])
+
+
+#
+# Set the average reply age in our stats, once we're done adding to them.
+#
+def set_average(stats):
+
+	stats["avg_reply_age"] = None
+	if stats["num_tweets_reply_timed"]:
+		stats["avg_reply_age"] = stats["sum_reply_age"] / stats["num_tweets_reply_timed"]
+
+
+#
+# Return a query for the columns of a user's tweets that go into our stats.
+#
+def get_tweets_query(session, username, start_time_t, end_time_t):
+	return(filter_window(session.query(Tweets.time_t, Tweets.reply_tweet_id, Tweets.reply_age),
+		username, start_time_t).filter(Tweets.time_t < end_time_t))
+
+
+#
+# Calculate the stats for a user's tweets in a time range, straight from the tweets table.
+#
+def get_tweets_stats(session, username, start_time_t, end_time_t):
+
+	retval = get_empty_stats()
+
+	for row in get_tweets_query(session, username, start_time_t, end_time_t):
+		add_tweet(retval, row.reply_tweet_id, row.reply_age)
+
+	return(retval)
+
+
+#
+# Turn our stats for a bucket into a row for the rollups table.
+#
+def get_stats_row(username, bucket_time_t, stats):
+
+	retval = {
+		"username": username,
+		"bucket_time_t": bucket_time_t,
+		"num_tweets": stats["num_tweets"],
+		"num_tweets_reply": stats["num_tweets_reply"],
+		"num_tweets_reply_timed": stats["num_tweets_reply_timed"],
+		"sum_reply_age": stats["sum_reply_age"],
+		"min_reply_age": stats["min_reply_age"],
+		"max_reply_age": stats["max_reply_age"],
+		"sketch": stats["sketch"].json(),
+		}
+
+	return(retval)
+
+
+#
+# Recalculate the rollups for every bucket that some tweets fall in.
+#
+# Each bucket is recalculated from the tweets table rather than adjusted,
+# so this can be called as often as we like for the same tweets.
+# The caller commits this along with the tweets themselves.
+#
+# tweets - A list of (username, time_t) tuples of tweets that were written or backfilled
+#
+def update_rollups(session, tweets):
+
+	buckets = set([ (username, get_bucket(time_t)) for (username, time_t) in tweets ])
+
+	for (username, bucket_time_t) in sorted(buckets):
+
+		stats = get_tweets_stats(session, username, bucket_time_t, bucket_time_t + bucket_size)
+
+		if stats["num_tweets"]:
+			session.merge(Rollups(**get_stats_row(username, bucket_time_t, stats)))
+		else:
+			session.query(Rollups).filter(Rollups.username == username).filter(
+				Rollups.bucket_time_t == bucket_time_t).delete()
+
+	logger.debug("Updated {} rollups".format(len(buckets)))
+
+
+#
+# Throw out our rollups and recalculate all of them from the tweets table.
+#
+def rebuild_rollups(session):
+
+	start = time.time()
+	session.query(Rollups).delete()
+
+	rows = []
+	key = None
+	stats = None
+
+	#
+	# Tweets come back in bucket order from the index, so we only
+	# need to hang onto one bucket at a time.
+	#
+	query = session.query(Tweets.username, Tweets.time_t, Tweets.reply_tweet_id,
+		Tweets.reply_age).order_by(Tweets.username, Tweets.time_t).yield_per(10000)
+
+	for row in query:
+
+		if key != (row.username, get_bucket(row.time_t)):
+			if key:
+				rows.append(get_stats_row(key[0], key[1], stats))
+			key = (row.username, get_bucket(row.time_t))
+			stats = get_empty_stats()
+
+		add_tweet(stats, row.reply_tweet_id, row.reply_age)
+
+	if key:
+		rows.append(get_stats_row(key[0], key[1], stats))
+
+	if len(rows):
+		session.execute(Rollups.__table__.insert(), rows)
+	session.commit()
+
+	logger.info("Rebuilt {} rollups in {:.2f} seconds".format(len(rows), time.time() - start))
+
+
+#
+# Databases from before we had rollups will have tweets but no rollups,
+# so build them the first time we see one of those.
+#
+def migrate_rollups(session):
+
+	if session.query(Rollups.username).first():
+		return
+
+	if not session.query(Tweets.id).first():
+		return
+
+	logger.info("Building rollups for existing tweets...")
+	rebuild_rollups(session)
+
+
+#
+# Return the start of the first whole bucket in a window.
+#
+def get_boundary(start_time_t):
+
+	retval = get_bucket(start_time_t)
+	if retval < start_time_t:
+		retval += bucket_size
+
+	return(retval)
+
+
+#
+# Return the stats for a user's tweets since several different times,
+# as a dictionary keyed by start time.
+#
+# The whole buckets in each window come from the rollups table, and
+# the partial bucket at the start of each window comes from the tweets table.
+#
+# The rollups are read in one pass over the largest window: the totals are added
+# up for every window at once by the database, and each bucket's sketch is loaded
+# once and counted towards every window that it falls in.
+#
+def get_rollup_stats_windows(session, username, start_times):
+
+	retval = {}
+
+	boundaries = { start_time_t: get_boundary(start_time_t) for start_time_t in start_times }
+
+	totals = get_rollup_totals_query(session, username,
+		[ boundaries[start_time_t] for start_time_t in start_times ]).one()
+
+	#
+	# Go through the buckets from newest to oldest, adding up their sketches as we go.
+	# Whenever we pass the start of a window, the sketch so far is that window's sketch.
+	#
+	sketches = {}
+	sketch = Sketch()
+	windows = sorted(start_times, key = lambda start_time_t: boundaries[start_time_t], reverse = True)
+
+	rows = get_rollup_sketches_query(session, username, min(boundaries.values()))
+
+	for row in rows:
+		while windows and row.bucket_time_t < boundaries[windows[0]]:
+			sketches[windows.pop(0)] = sketch.copy()
+		sketch.merge(from_json(row.sketch))
+
+	for start_time_t in windows:
+		sketches[start_time_t] = sketch.copy()
+
+	keys = [ "num_tweets", "num_tweets_reply", "num_tweets_reply_timed",
+		"sum_reply_age", "min_reply_age", "max_reply_age" ]
+
+	for index, start_time_t in enumerate(start_times):
+
+		stats = get_tweets_stats(session, username, start_time_t, boundaries[start_time_t])
+
+		#
+		# Postgres adds up a BIGINT into a NUMERIC, which would come back as a Decimal.
+		#
+		window_totals = [ value if value is None else int(value) for value in
+			totals[index * len(keys):(index + 1) * len(keys)] ]
+		merge_stats(stats, { **dict(zip(keys, window_totals)), "sketch": sketches[start_time_t] })
+
+		set_average(stats)
+
+		retval[start_time_t] = stats
+
+	return(retval)
+
+
+#
+# Return the stats for a user's tweets since a specific time.
+#
+def get_rollup_stats(session, username, start_time_t):
+	return(get_rollup_stats_windows(session, username, [ start_time_t ])[start_time_t])
+
+
@@ -0,0 +1,167 @@
+#
+# Parse the start of a report's time window, such as "6 hours ago" or "7d".
+#
+# Our windows are almost always a number of hours, days, etc. ago, so we parse
+# those once into an offset that's subtracted from the current time for each
+# report, which costs next to nothing. Anything else is handed to dateparser,
+# which understands just about anything but is very slow, so it's only
+# imported if we need it.
+#
+# These are all understood without dateparser:
+#
+# - Compact durations: 30m, 6h, 7d, 2w, 3mo, 1y, and combinations like 1d12h
+# - Written out, with or without "ago": 6 hours ago, one day ago, 2 weeks
+# - With underscores instead of spaces, for docker-compose: 1_days_ago
+#
+
+import calendar
+import datetime
+import logging as logger
+import re
+import time
+
+from dateutil.relativedelta import relativedelta
+
+
+#
+# The units we understand, and the relativedelta argument each one is for.
+# Plurals are handled by dropping a trailing "s".
+#
+units = {
+	"s": "seconds", "sec": "seconds", "second": "seconds",
+	"m": "minutes", "min": "minutes", "minute": "minutes",
+	"h": "hours", "hr": "hours", "hour": "hours",
+	"d": "days", "day": "days",
+	"w": "weeks", "wk": "weeks", "week": "weeks",
+	"mo": "months", "mon": "months", "month": "months",
+	"y": "years", "yr": "years", "year": "years",
+	}
+
+#
+# Numbers that can be written out.
+#
+numbers = {"a": 1, "an": 1, "one": 1}
+
+#
+# One amount, like "6h" or "6 hours". Several can follow each other, like "1d12h".
+#
+amount = re.compile(r"(\d+|an|a|one)\s*([a-z]+)\s*")
+
+
+#
+# This class holds a parsed time window, and works out when it starts.
+#
+class Since:
+
+	#
+	# What we were given, such as "6 hours ago".
+	#
+	text = None
+
+	#
+	# How far back the window goes, or None if we need dateparser for this one.
+	#
+	delta = None
+
+
+	def __init__(self, text, delta):
+		self.text = text
+		self.delta = delta
+
+
+	#
+	# Return the time_t that our window starts at.
+	#
+	# now - The time_t to count back from. Defaults to the current time.
+	#
+	def get_start_time_t(self, now = None):
+
+		if self.delta is None:
+			return(parse_dateparser(self.text))
+
+		if now is None:
+			now = time.time()
+
+		#
+		# Months and years don't have a fixed length, so count back on the calendar, in GMT.
+		#
+		start = datetime.datetime.utcfromtimestamp(now) - self.delta
+		retval = calendar.timegm(start.timetuple())
+
+		return(retval)
+
+
+#
+# Parse a time window into a relativedelta, or return None if it's not one we understand.
+#
+def parse_delta(text):
+
+	text = text.lower().replace("_", " ").strip()
+	text = re.sub(r"\s+ago$", "", text)
+
+	if not text:
+		return(None)
+
+	retval = relativedelta()
+
+	index = 0
+	while index < len(text):
+
+		match = amount.match(text, index)
+		if not match:
+			return(None)
+		index = match.end()
+
+		(number, unit) = match.groups()
+
+		if unit not in units and unit.endswith("s"):
+			unit = unit[:-1]
+
+		if unit not in units:
+			return(None)
+
+		number = numbers.get(number) or int(number)
+		retval += relativedelta(**{ units[unit]: number })
+
+	return(retval)
+
+
+#
+# Parse a time window with dateparser and return the time_t it starts at.
+#
+def parse_dateparser(text):
+
+	import dateparser
+
+	#
+	# All times should be in GMT, so we're going to force that here
+	#
+	start = dateparser.parse(text + " GMT")
+
+	if not start:
+		raise Exception("Unable to parse our time string: {}".format(text))
+	logger.debug("Timestamp {} parsed as: {}".format(text, start))
+
+	retval = time.mktime(start.timetuple())
+
+	return(retval)
+
+
+#
+# Parse a time window, such as "6 hours ago" or "7d", and return a Since object.
+#
+# Anything we don't understand ourselves is checked with dateparser now,
+# so a bad time window is caught right away rather than at report time.
+#
+def parse_since(text):
+
+	delta = parse_delta(text)
+	retval = Since(text, delta)
+
+	if delta is None:
+		logger.info("Parsing \"{}\" with dateparser".format(text))
+		parse_dateparser(text)
+
+	return(retval)
+
+
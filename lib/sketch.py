@@ -0,0 +1,155 @@
+#
+# A small, mergeable sketch for estimating percentiles, along the lines of DDSketch.
+#
+# Values are counted in buckets whose boundaries grow geometrically, so any
+# percentile we estimate is within relative_accuracy of the true value, and
+# the size of the sketch only depends on the range of the values, not on how
+# many there are. Two sketches are merged by adding up their buckets, which
+# is what lets us keep a sketch per hour and then combine them for any window.
+#
+
+import json
+import math
+
+
+class Sketch:
+
+	#
+	# How close our estimates are to the true values, as a fraction of the value.
+	#
+	relative_accuracy = 0.01
+
+	#
+	# How much bigger each bucket is than the one before it.
+	#
+	gamma = 0
+	log_gamma = 0
+
+	#
+	# Counts of values in each bucket, keyed by bucket index.
+	# Values of zero or less are counted separately in zero_count.
+	#
+	bins = None
+	zero_count = 0
+
+	#
+	# How many values we have seen, and the smallest and largest of them.
+	# Our estimates are clamped to these, so the 0th and 100th percentiles are exact.
+	#
+	count = 0
+	min = None
+	max = None
+
+
+	def __init__(self):
+		self.bins = {}
+		self.gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+		self.log_gamma = math.log(self.gamma)
+
+
+	#
+	# Add a value to the sketch.
+	#
+	def add(self, value, count = 1):
+
+		if value > 0:
+			index = math.ceil(math.log(value) / self.log_gamma)
+			self.bins[index] = self.bins.get(index, 0) + count
+		else:
+			self.zero_count += count
+
+		self.count += count
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+
+
+	#
+	# Add every value from another sketch into this one.
+	#
+	def merge(self, other):
+
+		for index, count in other.bins.items():
+			self.bins[index] = self.bins.get(index, 0) + count
+
+		self.zero_count += other.zero_count
+		self.count += other.count
+
+		if other.min is not None and (self.min is None or other.min < self.min):
+			self.min = other.min
+		if other.max is not None and (self.max is None or other.max > self.max):
+			self.max = other.max
+
+
+	#
+	# Return a copy of this sketch.
+	#
+	def copy(self):
+
+		retval = Sketch()
+		retval.merge(self)
+
+		return(retval)
+
+
+	#
+	# Estimate a percentile, from 0 to 100. Returns None if the sketch is empty.
+	#
+	def get_percentile(self, percentile):
+
+		if not self.count:
+			return(None)
+
+		rank = (self.count - 1) * percentile / 100
+
+		retval = None
+		seen = self.zero_count
+		if seen > rank:
+			retval = 0
+
+		else:
+			for index in sorted(self.bins):
+				seen += self.bins[index]
+				if seen > rank:
+					retval = 2 * self.gamma ** index / (self.gamma + 1)
+					break
+
+		retval = min(max(retval, self.min), self.max)
+
+		return(retval)
+
+
+	#
+	# Return the sketch as a JSON string, for storing in the database.
+	#
+	def json(self):
+
+		retval = {
+			"bins": self.bins,
+			"zero_count": self.zero_count,
+			"count": self.count,
+			"min": self.min,
+			"max": self.max,
+			}
+
+		return(json.dumps(retval))
+
+
+#
+# Load a sketch from the JSON string created by Sketch.json().
+#
+def from_json(string):
+
+	data = json.loads(string)
+
+	retval = Sketch()
+	retval.bins = { int(index): count for index, count in data["bins"].items() }
+	retval.zero_count = data["zero_count"]
+	retval.count = data["count"]
+	retval.min = data["min"]
+	retval.max = data["max"]
+
+	return(retval)
+
+
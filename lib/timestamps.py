@@ -0,0 +1,46 @@
+import calendar
+
+import dateutil.parser
+
+
+#
+# Month abbreviations as used by Twitter's API.
+#
+months = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+	"Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+
+#
+# Parse a timestamp from Twitter's API, such as "Wed Oct 10 20:19:24 +0000 2018",
+# and return the time_t.
+#
+# Twitter always uses the same format, so we pick it apart ourselves,
+# which is much faster than dateutil's generic parser. Anything that
+# doesn't look like that format is handed off to dateutil.
+#
+def parse_twitter_time(string):
+
+	try:
+		(weekday, month, day, hms, offset, year) = string.split(" ")
+		(hour, minute, second) = hms.split(":")
+
+		retval = calendar.timegm((int(year), months[month], int(day),
+			int(hour), int(minute), int(second)))
+
+		#
+		# Offsets look like "+0000", and are in hours and minutes.
+		#
+		if offset != "+0000":
+			offset_secs = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+			if offset[0] == "-":
+				offset_secs = -offset_secs
+			elif offset[0] != "+":
+				raise ValueError("Bad offset: {}".format(offset))
+			retval -= offset_secs
+
+		return(retval)
+
+	except (ValueError, KeyError):
+		return(int(dateutil.parser.parse(string).timestamp()))
+
+